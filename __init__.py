@@ -0,0 +1 @@
+default_app_config = 'mediaset.dashboard.transfer.apps.TransferConfig'
@@ -1,6 +1,22 @@
 from django.contrib import admin
-from .models import DataImport, ProductPricesTransfer
+from django.utils.translation import ugettext_lazy as _
+
+from .imports import rollback_prices
+from .models import DataImport, ProductPricesTransfer, ImportJob, PriceHistory
+
+
+class PriceHistoryAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'data_import', 'changes_count', 'rolled_back')
+    actions = ['rollback']
+
+    def rollback(self, request, queryset):
+        for history in queryset.filter(rolled_back=False).order_by('-creation_date'):
+            rollback_prices(history)
+
+    rollback.short_description = _('Roll back prices')
 
 
 admin.site.register(DataImport)
 admin.site.register(ProductPricesTransfer)
+admin.site.register(ImportJob)
+admin.site.register(PriceHistory, PriceHistoryAdmin)
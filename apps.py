@@ -1,5 +1,11 @@
 from django.apps import AppConfig
+from django.core import checks
 
 
 class TransferConfig(AppConfig):
-    name = 'transfer'
+    name = 'mediaset.dashboard.transfer'
+
+    def ready(self):
+        from . import signals  # noqa
+        from .checks import check_shared_cache
+        checks.register(check_shared_cache)
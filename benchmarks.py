@@ -0,0 +1,227 @@
+import math
+import os
+import random
+import time
+
+from openpyxl import Workbook
+
+from django.conf import settings
+from django.test import RequestFactory
+
+from mediaset.shop.catalogue.models import (
+    Product, Category, NewParameter, NewCategoryParameter, NewParameterValue, NewProductParameterValue,
+    CarBrandModel)
+from mediaset.shop.stock.models import StockRecord, Provider
+from mediaset.dashboard.transfer.caches import (
+    bump_catalogue_version, bump_product_version, bump_reference_version)
+from mediaset.dashboard.transfer.columns import PriceColumns
+from mediaset.dashboard.transfer.exports import EXPORT_CHUNK_SIZE
+from mediaset.dashboard.transfer.imports import (
+    FULL_HEADER, PRICE_HEADER, PriceBookValidator, ProductImportPipeline, changed_prices, iter_new_rows,
+    stage_prices)
+from mediaset.dashboard.transfer.instrumentation import trace
+from mediaset.dashboard.transfer.readers import UploadBook, create_data_import
+from mediaset.dashboard.transfer.utils import IMPORT_BATCH_SIZE
+from mediaset.dashboard.transfer.views import export_blank_view, export_prices_view, export_products_view
+
+
+def create_category(name):
+    if hasattr(Category, 'add_root'):
+        return Category.add_root(name=name)
+    return Category.objects.create(name=name)
+
+
+class SyntheticCatalogue:
+    """
+    Creates categories with parameters and values, providers, car models
+    and a given number of products with stock records, destinations and
+    parameter values.
+    """
+
+    def __init__(self, products, categories=5, parameters=4, values=8, car_models=20, seed=0):
+        self.size = products
+        self.category_count = categories
+        self.parameter_count = parameters
+        self.value_count = values
+        self.car_model_count = car_models
+        self.random = random.Random(seed)
+        self.products = {}
+        self.parameters = {}
+        self.values = {}
+
+    def create(self):
+        self.providers = [Provider.objects.get_or_create(name=str(settings.COMPANY))[0]]
+        self.providers += [Provider.objects.create(name='Provider {}'.format(i)) for i in range(3)]
+        self.car_models = [CarBrandModel.objects.create(value='Model {}'.format(i))
+                           for i in range(self.car_model_count)]
+        self.categories = [create_category('Category {}'.format(i)) for i in range(self.category_count)]
+
+        for category in self.categories:
+            parameters = [NewParameter.objects.create(name='{} param {}'.format(category.name, i), category=category)
+                          for i in range(self.parameter_count)]
+            NewCategoryParameter.objects.bulk_create(
+                [NewCategoryParameter(category=category, parameter=parameter) for parameter in parameters])
+            self.parameters[category.name] = parameters
+            for parameter in parameters:
+                NewParameterValue.objects.bulk_create(
+                    [NewParameterValue(parameter=parameter, value='Value {}'.format(i))
+                     for i in range(self.value_count)])
+                # bulk_create does not return ids on every backend
+                self.values[parameter.id] = list(NewParameterValue.objects.filter(parameter=parameter))
+
+        for index in range(self.size):
+            category = self.categories[index % self.category_count]
+            self.products.setdefault(category.name, []).append(
+                ('Product {}'.format(index), 'P{:07d}'.format(index), self.random.randint(100, 100000)))
+
+        for category in self.categories:
+            self.create_products(category)
+        bump_catalogue_version()
+        bump_product_version()
+        bump_reference_version()
+        return self
+
+    def create_products(self, category):
+        rows = self.products.get(category.name, [])
+        Product.objects.bulk_create(
+            [Product(name=name, code=code, category=category) for name, code, price in rows],
+            batch_size=IMPORT_BATCH_SIZE)
+        ids = dict(Product.objects.filter(category=category).values_list('code', 'id'))
+
+        StockRecord.objects.bulk_create(
+            [StockRecord(product_id=ids[code], price=price, provider=self.random.choice(self.providers),
+                         num_in_stock=self.random.randint(0, 50)) for name, code, price in rows],
+            batch_size=IMPORT_BATCH_SIZE)
+
+        field = Product._meta.get_field('destination')
+        through = field.remote_field.through
+        through.objects.bulk_create(
+            [through(**{'{}_id'.format(field.m2m_field_name()): ids[code],
+                        '{}_id'.format(field.m2m_reverse_field_name()): self.random.choice(self.car_models).id})
+             for name, code, price in rows],
+            batch_size=IMPORT_BATCH_SIZE)
+
+        NewProductParameterValue.objects.bulk_create(
+            [NewProductParameterValue(product_id=ids[code], parameter=parameter,
+                                      value=self.random.choice(self.values[parameter.id]))
+             for name, code, price in rows for parameter in self.parameters[category.name]],
+            batch_size=IMPORT_BATCH_SIZE)
+
+    def price_sheets(self, change_ratio=0.1):
+        """
+        Sheets of a price file for all products; change_ratio of the prices differ.
+        """
+        for category_name, rows in self.products.items():
+            sheet = [PRICE_HEADER]
+            for name, code, price in rows:
+                if self.random.random() < change_ratio:
+                    price += 1
+                sheet.append([name, code, '{}.00'.format(price)])
+            yield category_name, sheet
+
+    def full_sheets(self, rows):
+        """
+        Sheets of a full import file with rows new products.
+        """
+        for index, category in enumerate(self.categories):
+            parameters = self.parameters[category.name]
+            sheet = [FULL_HEADER + [parameter.name for parameter in parameters]]
+            for number in range(index, rows, self.category_count):
+                sheet.append(['New product {}'.format(number), 'N{:07d}'.format(number), 'Text',
+                              self.random.randint(100, 100000), self.random.choice(self.providers).name,
+                              self.random.randint(0, 50), self.random.choice(self.car_models).value] +
+                             [self.random.choice(self.values[parameter.id]).value for parameter in parameters])
+            yield category.name, sheet
+
+
+def write_workbook(path, sheets):
+    workbook = Workbook(write_only=True)
+    for title, rows in sheets:
+        worksheet = workbook.create_sheet(title=title[:31])
+        for row in rows:
+            worksheet.append(row)
+    workbook.save(path)
+    return path
+
+
+def measure(scenario, rows, budget, func):
+    started = time.perf_counter()
+    with trace('benchmark_{}'.format(scenario)) as record:
+        func()
+    seconds = time.perf_counter() - started
+    return {
+        'scenario': scenario,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(rows / seconds, 1) if seconds > 0 else 0,
+        'queries': record.queries.count,
+        'query_budget': budget,
+        'within_budget': record.queries.count <= budget,
+    }
+
+
+def consume(response):
+    for chunk in response:
+        pass
+    response.close()
+
+
+def run_benchmarks(rows, directory, categories=5, parameters=4):
+    """
+    Runs every scenario against a catalogue of rows products and returns
+    one result dict per scenario. Expects an empty database.
+    Query budgets count the queries of all threads of a scenario.
+    """
+    catalogue = SyntheticCatalogue(rows, categories=categories, parameters=parameters).create()
+    batches = math.ceil(rows / IMPORT_BATCH_SIZE) + categories
+    chunks = math.ceil(rows / EXPORT_CHUNK_SIZE) + categories
+    request = RequestFactory().get('/')
+    results = []
+
+    def export(view):
+        def run():
+            bump_catalogue_version()
+            consume(view(request))
+        return run
+
+    results.append(measure('export_prices', rows, 2 * chunks + 10, export(export_prices_view)))
+    results.append(measure('export_products', rows, 4 * chunks + 10, export(export_products_view)))
+    results.append(measure('export_blank', 0, 2 * categories + 10, export(export_blank_view)))
+
+    price_sheets = list(catalogue.price_sheets())
+    price_import = create_data_import(
+        write_workbook(os.path.join(directory, 'prices_{}.xlsx'.format(rows)), price_sheets))
+    price_book = UploadBook(price_import)
+    price_book.keys()
+    results.append(measure('get_validation', rows, 2 * batches + 10,
+                           lambda: PriceBookValidator().validate(price_book)))
+
+    prices = {row[1]: row[2] for category_name, sheet in price_sheets for row in sheet[1:]}
+    stage_prices(PriceColumns.from_mapping(prices), price_import)
+    results.append(measure('price_diff', rows, 2, lambda: list(changed_prices(price_import))))
+
+    full_import = create_data_import(
+        write_workbook(os.path.join(directory, 'full_{}.xlsx'.format(rows)), catalogue.full_sheets(rows)),
+        name='new_import_all')
+    full_book = UploadBook(full_import)
+    full_book.keys()
+    results.append(measure(
+        'import_all', rows, 12 * batches + categories * (parameters + 2) + 10,
+        lambda: ProductImportPipeline(settings.COMPANY).run(iter_new_rows(full_book))))
+
+    return results
+
+
+def compare(results, baseline):
+    """
+    Returns (scenario, rows, seconds, baseline seconds, ratio) for results
+    that have a baseline entry.
+    """
+    previous = {(item['scenario'], item['rows']): item for item in baseline}
+    comparison = []
+    for item in results:
+        old = previous.get((item['scenario'], item['rows']))
+        if old:
+            ratio = round(item['seconds'] / old['seconds'], 2) if old['seconds'] else None
+            comparison.append((item['scenario'], item['rows'], item['seconds'], old['seconds'], ratio))
+    return comparison
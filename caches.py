@@ -0,0 +1,276 @@
+import hashlib
+import os
+import pickle
+import struct
+import tempfile
+import time
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def cache_root():
+    return getattr(settings, 'TRANSFER_CACHE_ROOT', os.path.join(settings.MEDIA_ROOT, 'transfer_cache'))
+
+
+CACHE_ROOT = cache_root()
+BOOK_CACHE_MAX_SIZE = getattr(settings, 'TRANSFER_BOOK_CACHE_MAX_SIZE', 256 * 1024 * 1024)
+EXPORT_CACHE_MAX_SIZE = getattr(settings, 'TRANSFER_EXPORT_CACHE_MAX_SIZE', 512 * 1024 * 1024)
+BUILD_LOCK_TIMEOUT = getattr(settings, 'TRANSFER_BUILD_LOCK_TIMEOUT', 30 * 60)
+
+CATALOGUE_VERSION_KEY = 'transfer:catalogue-version'
+REFERENCE_VERSION_KEY = 'transfer:reference-version'
+PRODUCT_VERSION_KEY = 'transfer:product-version'
+
+
+def file_hash(field_file):
+    digest = hashlib.sha1()
+    field_file.open('rb')
+    for chunk in field_file.chunks():
+        digest.update(chunk)
+    field_file.seek(0)
+    return digest.hexdigest()
+
+
+def iter_file(path, chunk_size=64 * 1024):
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(chunk_size), b'')
+
+
+class FileCache:
+    """
+    Stores pickled, zlib-compressed values as files in the directory name
+    of the cache root. When the directory grows over max_size the least
+    recently used files are removed.
+    """
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+
+    @property
+    def directory(self):
+        # read on every use, so overridden settings move the cache
+        return os.path.join(cache_root(), self.name)
+
+    def path(self, key):
+        return os.path.join(self.directory, '{}.cache'.format(key))
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+            return None
+        os.utime(path)
+        return value
+
+    def set(self, key, value):
+        data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        self.write(key, lambda f: f.write(data))
+
+    def get_path(self, key):
+        """
+        Returns the path of a cached file entry or None.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def write(self, key, writer):
+        """
+        Calls writer with a binary file and stores its content under key
+        once the writer has finished without errors.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                writer(f)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict()
+        return self.path(key)
+
+    def lock_key(self, key):
+        return 'transfer:build-lock:{}:{}'.format(self.directory, key)
+
+    def tee(self, key, chunks):
+        """
+        Yields the byte strings of chunks and stores them under key once
+        all of them were yielded. Only the caller that holds the build
+        lock builds the entry; concurrent callers wait for it and then
+        yield the stored file.
+        """
+        lock_key = self.lock_key(key)
+        while True:
+            path = self.get_path(key)
+            if path is not None:
+                yield from iter_file(path)
+                return
+            if cache.add(lock_key, 1, BUILD_LOCK_TIMEOUT):
+                break
+            time.sleep(0.5)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        yield chunk
+                os.replace(tmp_path, self.path(key))
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self.evict()
+        finally:
+            cache.delete(lock_key)
+
+    def get_or_write(self, key, writer):
+        """
+        Returns the path of key, calling write(key, writer) if it is missing.
+        Concurrent callers wait for the one that holds the build lock
+        instead of building the same entry again.
+        """
+        lock_key = self.lock_key(key)
+        while True:
+            path = self.get_path(key)
+            if path is not None:
+                return path
+            if cache.add(lock_key, 1, BUILD_LOCK_TIMEOUT):
+                try:
+                    return self.get_path(key) or self.write(key, writer)
+                finally:
+                    cache.delete(lock_key)
+            time.sleep(0.5)
+
+    def get_or_set(self, key, default):
+        value = self.get(key)
+        if value is None:
+            value = default()
+            self.set(key, value)
+        return value
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.cache'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+book_cache = FileCache('books', BOOK_CACHE_MAX_SIZE)
+export_cache = FileCache('exports', EXPORT_CACHE_MAX_SIZE)
+
+
+def get_version(key):
+    # start from the current time so a flushed cache never brings back
+    # a version that was already used for cached data
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        return get_version(key)
+
+
+def get_catalogue_version():
+    return get_version(CATALOGUE_VERSION_KEY)
+
+
+def bump_catalogue_version():
+    return bump_version(CATALOGUE_VERSION_KEY)
+
+
+def get_reference_version():
+    return get_version(REFERENCE_VERSION_KEY)
+
+
+def bump_reference_version():
+    return bump_version(REFERENCE_VERSION_KEY)
+
+
+def get_product_version():
+    return get_version(PRODUCT_VERSION_KEY)
+
+
+def bump_product_version():
+    return bump_version(PRODUCT_VERSION_KEY)
+
+
+def write_frame(f, value):
+    data = zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    f.write(struct.pack('<I', len(data)))
+    f.write(data)
+
+
+def read_frame(f):
+    size = struct.unpack('<I', f.read(4))[0]
+    return pickle.loads(zlib.decompress(f.read(size)))
+
+
+def write_book(f, sheets, batch_size):
+    """
+    Writes (sheet name, rows) pairs as compressed frames of batch_size rows.
+    Sheets end with an empty frame; the file ends with an index of
+    (sheet name, offset, row count) so each sheet can be read on its own.
+    """
+    index = []
+    for name, rows in sheets:
+        offset = f.tell()
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write_frame(f, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            write_frame(f, batch)
+            count += len(batch)
+        write_frame(f, [])
+        index.append((name, offset, count))
+    index_offset = f.tell()
+    write_frame(f, index)
+    f.write(struct.pack('<Q', index_offset))
+
+
+def read_book_index(path):
+    with open(path, 'rb') as f:
+        f.seek(-8, os.SEEK_END)
+        f.seek(struct.unpack('<Q', f.read(8))[0])
+        return read_frame(f)
+
+
+def iter_book_rows(path, offset):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            batch = read_frame(f)
+            if not batch:
+                return
+            yield from batch
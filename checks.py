@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.checks import Warning
+
+
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """
+    Cache versions, build locks and job heartbeats live in the default
+    cache, so every process has to use the same one.
+    """
+    backend = settings.CACHES.get('default', {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES:
+        return [Warning(
+            'The default cache ({}) is not shared between processes.'.format(backend),
+            hint='Changes seen by one process do not invalidate the exports and code indexes of the others. '
+                 'Use a shared backend such as memcached, redis or the database cache.',
+            id='transfer.W001')]
+    return []
@@ -0,0 +1,138 @@
+import sys
+from array import array
+from decimal import Decimal, InvalidOperation
+
+from mediaset.dashboard.transfer.caches import book_cache
+from mediaset.dashboard.transfer.instrumentation import phase
+from mediaset.dashboard.transfer.utils import normalize_code, parse_num_in_stock, parse_price
+
+
+INVALID_PRICE = -2 ** 63
+MAX_CENTS = 2 ** 62
+
+
+def price_cents(price):
+    return int(price.quantize(Decimal('0.01')) * 100)
+
+
+def parse_cents(value):
+    """
+    Returns the price in value as whole cents, or INVALID_PRICE.
+    """
+    try:
+        cents = price_cents(parse_price(value))
+    except (ValueError, InvalidOperation):
+        return INVALID_PRICE
+    return cents if -MAX_CENTS < cents < MAX_CENTS else INVALID_PRICE
+
+
+def cents_to_price(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+class PriceColumns:
+    """
+    Rows of a price sheet stored column by column: interned names and
+    normalized codes, and prices in cents in a typed array, with
+    INVALID_PRICE for cells that are not numbers. Prices are parsed once
+    when the columns are built.
+    """
+
+    def __init__(self, header=None):
+        self.header = header
+        self.names = []
+        self.codes = []
+        self.cents = array('q')
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, name, code, price):
+        self.names.append(sys.intern(str(name)))
+        self.codes.append(sys.intern(normalize_code(code)))
+        self.cents.append(parse_cents(price))
+
+    def slice(self, start, end):
+        columns = PriceColumns(self.header)
+        columns.names = self.names[start:end]
+        columns.codes = self.codes[start:end]
+        columns.cents = self.cents[start:end]
+        return columns
+
+    def extend(self, columns):
+        self.names.extend(columns.names)
+        self.codes.extend(columns.codes)
+        self.cents.extend(columns.cents)
+
+    @classmethod
+    def from_rows(cls, rows, header=None):
+        columns = cls(header)
+        for row in rows:
+            columns.append(row[0], row[1], row[2])
+        return columns
+
+    @classmethod
+    def from_mapping(cls, prices):
+        """
+        Columns of {code: price}, e.g. prices posted from a review form.
+        """
+        columns = cls()
+        for code, price in prices.items():
+            columns.append('item', code, price)
+        return columns
+
+    def invalid_codes(self):
+        return [code for code, cents in zip(self.codes, self.cents) if cents == INVALID_PRICE]
+
+    def prices(self):
+        """
+        Returns {code: cents} of the valid prices; the last row wins for repeated codes.
+        """
+        return {code: cents for code, cents in zip(self.codes, self.cents) if cents != INVALID_PRICE}
+
+
+def read_price_columns(book, header):
+    """
+    Returns [(sheet name, PriceColumns)] of a price book, built once and
+    kept in the book cache. Sheets whose header is not header keep the
+    header only, for the validator to report.
+    """
+
+    def build():
+        sheets = []
+        for name, rows in book.items():
+            rows = iter(rows)
+            sheet_header = next(rows, None)
+            if sheet_header == header:
+                sheets.append((name, PriceColumns.from_rows(rows, sheet_header)))
+            else:
+                sheets.append((name, PriceColumns(sheet_header)))
+        return sheets
+
+    with phase('parse'):
+        return book_cache.get_or_set(book.cache_key('price-columns'), build)
+
+
+class StockColumns:
+    """
+    Stock columns (price, provider, num_in_stock) of full import rows:
+    prices in cents and stock counts in typed arrays, interned codes and
+    provider names. An empty price cell is a price of 0.
+    """
+
+    def __init__(self, rows):
+        self.codes = []
+        self.providers = []
+        self.cents = array('q')
+        self.num_in_stock = array('q')
+        for row in rows:
+            self.codes.append(sys.intern(normalize_code(row[1])))
+            self.cents.append(parse_cents(row[3]) if row[3] else 0)
+            self.providers.append(sys.intern(str(row[4])))
+            self.num_in_stock.append(parse_num_in_stock(row[5]))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def invalid_codes(self):
+        return [code for code, cents in zip(self.codes, self.cents) if cents == INVALID_PRICE]
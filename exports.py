@@ -0,0 +1,426 @@
+import csv
+import datetime
+import hashlib
+import io
+import os
+from functools import partial
+
+from openpyxl import Workbook
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from mediaset.shop.catalogue.models import Product, Category, NewCategoryParameter, NewProductParameterValue
+from mediaset.dashboard.catalogue.forms import ProductFilter
+from mediaset.shop.stock.models import StockRecord
+from mediaset.dashboard.transfer.caches import export_cache, get_catalogue_version, get_reference_version
+from mediaset.dashboard.transfer.instrumentation import add_rows, phase
+from mediaset.dashboard.transfer.utils import lookup_batches, ordered_map
+
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'TRANSFER_EXPORT_CHUNK_SIZE', 2000)
+EXPORT_WORKERS = getattr(settings, 'TRANSFER_EXPORT_WORKERS', min(4, os.cpu_count() or 1))
+
+
+def modified_field(model, setting, default):
+    """
+    Name of the modification time field of model given by setting. A
+    configured field that model does not have is an error; a missing
+    default field gives None, which disables delta exports on it.
+    """
+    name = getattr(settings, setting, None)
+    try:
+        model._meta.get_field(name or default)
+    except FieldDoesNotExist:
+        if name:
+            raise ImproperlyConfigured('{}: {} has no field {}'.format(setting, model.__name__, name))
+        return None
+    return name or default
+
+
+PRODUCT_MODIFIED_FIELD = modified_field(Product, 'TRANSFER_PRODUCT_MODIFIED_FIELD', 'date_updated')
+STOCK_MODIFIED_FIELD = modified_field(StockRecord, 'TRANSFER_STOCK_MODIFIED_FIELD', 'date_updated')
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+PRICE_FIELDS = ['name', 'code']
+PRODUCT_FIELDS = ['name', 'code', 'first_text']
+STOCK_FIELDS = ['price', 'provider', 'num_in_stock', 'destination']
+
+
+class Echo:
+    """
+    File-like object for csv.writer that returns the written line
+    instead of buffering it, so rows can be yielded to the response.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_chunks(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields lists of at most chunk_size objects, paginating by pk
+    instead of OFFSET so every chunk costs the same.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        add_rows(len(chunk))
+        yield chunk
+        last = chunk[-1].pk
+
+
+def iter_chunk_bounds(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields (after, last) pk bounds of the chunks iter_chunks would yield,
+    reading only the pks: a chunk holds the objects with after < pk <= last
+    (no lower bound for the first one).
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    after = None
+    while True:
+        chunk = list((pks if after is None else pks.filter(pk__gt=after))[:chunk_size])
+        if not chunk:
+            return
+        yield after, chunk[-1]
+        after = chunk[-1]
+
+
+def chunked_rows(queryset, chunk_rows, chunk_size=EXPORT_CHUNK_SIZE, workers=1, ids=None):
+    """
+    Yields the rows chunk_rows(chunk) returns for chunks of queryset, or
+    only of the objects with sorted ids if they are given. With more than
+    one worker the chunks are loaded and converted concurrently and
+    yielded in order; at most 2 * workers chunks are held at a time.
+    """
+    if ids is None and workers <= 1:
+        for chunk in iter_chunks(queryset, chunk_size):
+            yield from chunk_rows(chunk)
+        return
+
+    def load(part):
+        if ids is None:
+            after, last = part
+            chunk = queryset.filter(pk__lte=last)
+            if after is not None:
+                chunk = chunk.filter(pk__gt=after)
+        else:
+            chunk = queryset.filter(pk__in=part)
+        chunk = list(chunk.order_by('pk'))
+        add_rows(len(chunk))
+        return chunk_rows(chunk)
+
+    if ids is None:
+        parts = iter_chunk_bounds(queryset, chunk_size)
+    else:
+        parts = lookup_batches(ids, 'id', chunk_size)
+    for rows in ordered_map(load, parts, workers):
+        yield from rows
+
+
+class ExportFilter:
+    """
+    Limits an export to the products matching ProductFilter criteria
+    (code, name, category) and, with since, to the products whose product
+    row or stock record was modified at or after since. The modification
+    fields are TRANSFER_PRODUCT_MODIFIED_FIELD and
+    TRANSFER_STOCK_MODIFIED_FIELD.
+    """
+
+    def __init__(self, code='', name='', category=None, since=None):
+        if since and not (PRODUCT_MODIFIED_FIELD or STOCK_MODIFIED_FIELD):
+            raise ValueError('Выгрузка изменений недоступна: у товаров нет даты изменения')
+        self.code = code
+        self.name = name
+        self.category = category
+        self.since = since
+
+    @classmethod
+    def from_request(cls, request):
+        form = ProductFilter(request.GET)
+        if not form.is_valid():
+            if any(request.GET.get(name) for name in form.fields):
+                raise ValueError('Некорректный фильтр: {}'.format(', '.join(form.errors)))
+            return cls(since=parse_since(request.GET.get('since')))
+        data = form.cleaned_data
+        return cls(code=data.get('code') or '', name=data.get('name') or '', category=data.get('category'),
+                   since=parse_since(request.GET.get('since')))
+
+    def __bool__(self):
+        return bool(self.code or self.name or self.category or self.since)
+
+    def apply(self, products):
+        """
+        Filters products by code, name and category; since is applied
+        through modified_ids.
+        """
+        if self.code:
+            products = products.filter(code__icontains=self.code)
+        if self.name:
+            products = products.filter(name__icontains=self.name)
+        if self.category:
+            products = products.filter(category=self.category)
+        return products
+
+    def modified_ids(self, products):
+        """
+        Returns {category id: sorted ids} of products modified since
+        self.since. The modified ids come from one query per modification
+        field, so each can use its index, and only they are checked
+        against products.
+        """
+        ids = set()
+        if PRODUCT_MODIFIED_FIELD:
+            ids.update(Product.objects.filter(
+                **{'{}__gte'.format(PRODUCT_MODIFIED_FIELD): self.since}).values_list('id', flat=True))
+        if STOCK_MODIFIED_FIELD:
+            ids.update(StockRecord.objects.filter(
+                **{'{}__gte'.format(STOCK_MODIFIED_FIELD): self.since}).values_list('product_id', flat=True))
+        categories = {}
+        for batch in lookup_batches(sorted(ids), 'id'):
+            for pk, category_id in products.filter(id__in=batch).values_list('id', 'category_id'):
+                categories.setdefault(category_id, []).append(pk)
+        for category_ids in categories.values():
+            category_ids.sort()
+        return categories
+
+    def cache_key(self):
+        if not self:
+            return ''
+        category = getattr(self.category, 'pk', self.category)
+        value = repr((self.code, self.name, category, self.since and self.since.isoformat()))
+        return hashlib.sha1(value.encode()).hexdigest()[:16]
+
+
+def parse_since(value):
+    """
+    Parses an ISO date or date and time; dates mean their midnight.
+    """
+    if not value:
+        return None
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('Некорректная дата: {}'.format(value))
+        since = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ and timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def export_products(export_filter=None):
+    products = Product.objects.all()
+    return export_filter.apply(products) if export_filter else products
+
+
+def export_categories(products=None):
+    products = Product.objects.all() if products is None else products
+    categories = Category.objects.filter(id__in=products.values('category_id'))
+    return [category for category in categories if '/' not in category.name]
+
+
+def category_parameter_names(category):
+    return sorted(set(NewCategoryParameter.objects.filter(category=category).values_list('parameter__name', flat=True)))
+
+
+def price_chunk_rows(chunk):
+    prices = dict(StockRecord.objects.filter(product__in=chunk).values_list('product_id', 'price'))
+    rows = []
+    for product in chunk:
+        row = [str(getattr(product, field, '')) for field in PRICE_FIELDS]
+        row.append(str(prices.get(product.id, '0')))
+        rows.append(row)
+    return rows
+
+
+def price_rows(category, chunk_size=EXPORT_CHUNK_SIZE, products=None, workers=1, ids=None):
+    products = (Product.objects.all() if products is None else products).filter(category=category)
+    return chunked_rows(products, price_chunk_rows, chunk_size, workers, ids)
+
+
+class ParameterMatrix:
+    """
+    Product x parameter values of one chunk, stored column by column:
+    columns[parameter][row] is the value of the product at position row.
+    """
+
+    def __init__(self, product_ids, parameter_names):
+        self.rows = {product_id: index for index, product_id in enumerate(product_ids)}
+        self.parameters = {name: index for index, name in enumerate(parameter_names)}
+        self.columns = [[''] * len(product_ids) for name in parameter_names]
+
+    def set(self, product_id, parameter_name, value):
+        self.columns[self.parameters[parameter_name]][self.rows[product_id]] = value
+
+    def row(self, index):
+        return [column[index] for column in self.columns]
+
+
+def product_relations(product_ids, parameter_names):
+    """
+    Loads stock records, destinations and parameter values of products
+    with three queries, however many products and parameters there are.
+    """
+    stock_records = {
+        product_id: [str(price), str(provider), str(num_in_stock)]
+        for product_id, price, provider, num_in_stock in StockRecord.objects.filter(
+            product_id__in=product_ids).values_list('product_id', 'price', 'provider__name', 'num_in_stock')}
+
+    field = Product._meta.get_field('destination')
+    destinations = {}
+    for product_id, value in field.remote_field.through.objects.filter(
+            **{'{}_id__in'.format(field.m2m_field_name()): product_ids}).values_list(
+            '{}_id'.format(field.m2m_field_name()), '{}__value'.format(field.m2m_reverse_field_name())):
+        destinations.setdefault(product_id, []).append(str(value))
+
+    matrix = ParameterMatrix(product_ids, parameter_names)
+    if parameter_names:
+        for product_id, name, value in NewProductParameterValue.objects.filter(
+                product_id__in=product_ids, parameter__name__in=parameter_names).values_list(
+                'product_id', 'parameter__name', 'value__value'):
+            matrix.set(product_id, name, value)
+
+    return stock_records, destinations, matrix
+
+
+def product_chunk_rows(chunk, parameter_names):
+    product_ids = [product.id for product in chunk]
+    stock_records, destinations, matrix = product_relations(product_ids, parameter_names)
+    rows = []
+    for index, product in enumerate(chunk):
+        row = [str(getattr(product, field, '')) for field in PRODUCT_FIELDS]
+        row += stock_records.get(product.id, ['0', '', ''])
+        row.append(', '.join(destinations.get(product.id, [])))
+        row += matrix.row(index)
+        rows.append(row)
+    return rows
+
+
+def product_rows(category, parameter_names, chunk_size=EXPORT_CHUNK_SIZE, products=None, workers=1, ids=None):
+    products = (Product.objects.all() if products is None else products).filter(category=category)
+    products = products.only(*(['id'] + PRODUCT_FIELDS))
+    return chunked_rows(products, partial(product_chunk_rows, parameter_names=parameter_names), chunk_size,
+                        workers, ids)
+
+
+def price_sheet(category, chunk_size=EXPORT_CHUNK_SIZE, products=None, workers=1, ids=None):
+    return str(category.name), PRICE_FIELDS + ['price'], price_rows(category, chunk_size, products, workers, ids)
+
+
+def product_sheet(category, chunk_size=EXPORT_CHUNK_SIZE, products=None, workers=1, ids=None):
+    parameter_names = category_parameter_names(category)
+    header = PRODUCT_FIELDS + STOCK_FIELDS + parameter_names
+    return str(category.name), header, product_rows(category, parameter_names, chunk_size, products, workers, ids)
+
+
+def export_sheets(sheet, workers, chunk_size, export_filter):
+    """
+    Yields sheet(category, ...) for every category of the export, one
+    after the other; with more than one worker the chunks of a sheet are
+    built concurrently, see chunked_rows. A delta export (since) reads
+    only the modified products.
+    """
+    products = export_products(export_filter)
+    if export_filter and export_filter.since:
+        modified = export_filter.modified_ids(products)
+        categories = [category for category in Category.objects.filter(id__in=list(modified))
+                      if '/' not in category.name]
+    else:
+        modified = {}
+        categories = export_categories(products)
+    for category in categories:
+        yield sheet(category, chunk_size, products, workers, modified.get(category.id))
+
+
+def price_sheets(workers=EXPORT_WORKERS, chunk_size=EXPORT_CHUNK_SIZE, export_filter=None):
+    return export_sheets(price_sheet, workers, chunk_size, export_filter)
+
+
+def product_sheets(workers=EXPORT_WORKERS, chunk_size=EXPORT_CHUNK_SIZE, export_filter=None):
+    return export_sheets(product_sheet, workers, chunk_size, export_filter)
+
+
+def blank_sheets(export_filter=None):
+    categories = Category.objects.all()
+    if export_filter and export_filter.category:
+        categories = categories.filter(pk=getattr(export_filter.category, 'pk', export_filter.category))
+    for category in categories:
+        if '/' not in category.name:
+            yield str(category.name), PRODUCT_FIELDS + STOCK_FIELDS + category_parameter_names(category), []
+
+
+EXPORTS = {
+    'prices': price_sheets,
+    'products': product_sheets,
+    'blank': blank_sheets,
+}
+
+
+def iter_csv_lines(sheets):
+    """
+    Yields all sheets as lines of one csv file. Every sheet starts with its
+    own header row and every row is prefixed with the sheet (category) name.
+    """
+    writer = csv.writer(Echo())
+    for title, header, rows in sheets:
+        yield writer.writerow(['category'] + header)
+        for row in rows:
+            yield writer.writerow([title] + row)
+
+
+def write_csv(sheets, file_obj):
+    text = io.TextIOWrapper(file_obj, encoding='utf-8', newline='')
+    text.writelines(iter_csv_lines(sheets))
+    text.flush()
+    text.detach()
+
+
+def write_xlsx(sheets, file_obj):
+    # write-only workbooks flush every appended row to a temporary file,
+    # so memory does not grow with the number of rows
+    workbook = Workbook(write_only=True)
+    for title, header, rows in sheets:
+        worksheet = workbook.create_sheet(title=title[:31])
+        worksheet.append(header)
+        for row in rows:
+            worksheet.append(row)
+    workbook.save(file_obj)
+
+
+def cached_export_response(request, kind, file_name, export_filter=None):
+    """
+    Serves the export of kind, limited by export_filter, from the export
+    cache. Entries are keyed by the catalogue and reference versions, which
+    model signals bump on every change, and by the filter. A missing csv
+    entry is streamed to the client while it is cached and concurrent
+    requests stream it once it is stored; a missing xlsx entry is built
+    once by concurrent requests and then sent.
+    """
+    file_format = 'csv' if request.GET.get('format') == 'csv' else 'xlsx'
+    content_type = 'text/csv' if file_format == 'csv' else XLSX_CONTENT_TYPE
+    key = '{}-{}-{}-{}'.format(kind, get_catalogue_version(), get_reference_version(), file_format)
+    if export_filter:
+        key = '{}-{}'.format(key, export_filter.cache_key())
+
+    path = export_cache.get_path(key)
+    if path is None and file_format == 'csv':
+        lines = iter_csv_lines(EXPORTS[kind](export_filter=export_filter))
+        response = StreamingHttpResponse(export_cache.tee(key, (line.encode('utf-8') for line in lines)),
+                                         content_type=content_type)
+    else:
+        if path is None:
+            with phase('render'):
+                path = export_cache.get_or_write(
+                    key, lambda f: write_xlsx(EXPORTS[kind](export_filter=export_filter), f))
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(file_name, file_format)
+    return response
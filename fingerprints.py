@@ -0,0 +1,88 @@
+import hashlib
+from array import array
+from bisect import bisect_left
+
+from mediaset.dashboard.transfer.columns import parse_cents
+from mediaset.dashboard.transfer.models import PriceSnapshot
+from mediaset.dashboard.transfer.utils import normalize_code
+
+
+def code_fingerprint(code):
+    return int.from_bytes(hashlib.blake2b(normalize_code(code).encode(), digest_size=8).digest(), 'little')
+
+
+class PriceFingerprints:
+    """
+    Last imported price of every code of a supplier file stream, kept as
+    two arrays: sorted 64-bit code fingerprints and prices in cents.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.codes = array('Q')
+        self.prices = array('q')
+        self.codes.frombytes(bytes(snapshot.codes))
+        self.prices.frombytes(bytes(snapshot.prices))
+
+    @classmethod
+    def for_stream(cls, stream):
+        return cls(PriceSnapshot.objects.filter(stream=stream).first() or PriceSnapshot(stream=stream))
+
+    @property
+    def version(self):
+        return self.snapshot.last_edit_date.strftime('%Y%m%d%H%M%S%f') if self.snapshot.last_edit_date else '0'
+
+    def get(self, code):
+        fingerprint = code_fingerprint(code)
+        index = bisect_left(self.codes, fingerprint)
+        if index < len(self.codes) and self.codes[index] == fingerprint:
+            return self.prices[index]
+        return None
+
+    def unchanged(self, code, price):
+        return self.get(code) == parse_cents(price)
+
+    def update(self, prices):
+        """
+        Stores {code: price in cents} as the last imported prices.
+        """
+        merged = dict(zip(self.codes, self.prices))
+        for code, cents in prices.items():
+            merged[code_fingerprint(code)] = cents
+        fingerprints = sorted(merged)
+        self.codes = array('Q', fingerprints)
+        self.prices = array('q', [merged[fingerprint] for fingerprint in fingerprints])
+        self.snapshot.codes = self.codes.tobytes()
+        self.snapshot.prices = self.prices.tobytes()
+        self.snapshot.save()
+
+
+class IncrementalPriceBook:
+    """
+    Wraps a price book and drops rows whose price did not change since the
+    last import of the stream while the rows are read.
+    """
+
+    def __init__(self, book, fingerprints):
+        self.book = book
+        self.fingerprints = fingerprints
+
+    def cache_key(self, stage):
+        return self.book.cache_key('{}-{}'.format(stage, self.fingerprints.version))
+
+    def keys(self):
+        return self.book.keys()
+
+    def items(self):
+        for name, rows in self.book.items():
+            yield name, self.changed_rows(rows)
+
+    def changed_rows(self, rows):
+        rows = iter(rows)
+        header = next(rows, None)
+        if header is None:
+            return
+        yield header
+        for row in rows:
+            if len(row) < 3 or not self.fingerprints.unchanged(row[1], row[2]):
+                yield row
@@ -3,12 +3,13 @@ from django.forms.widgets import HiddenInput
 from .models import DataImport
 from django.forms import modelformset_factory
 from mediaset.shop.catalogue.models import Product
+from mediaset.dashboard.catalogue.forms import ProductListImageFormSet
 
 
 class DataImportForm(forms.ModelForm):
     class Meta:
         model = DataImport
-        fields = ('upload',)
+        fields = ('upload', 'stream')
 
 
 class DataImportAllForm(forms.ModelForm):
@@ -37,4 +38,18 @@ BaseProductFormSet = modelformset_factory(Product, form=ProductListForm, extra=0
 
 
 class ProductFormSet(BaseProductFormSet):
-    pass
\ No newline at end of file
+    pass
+
+
+class PageImageFormSet(ProductListImageFormSet):
+    """
+    Image formset of one product of a page, given the product's images
+    loaded together with the images of the whole page.
+    """
+
+    def __init__(self, *args, images=(), **kwargs):
+        self.images = list(images)
+        super().__init__(*args, **kwargs)
+
+    def get_queryset(self):
+        return self.images
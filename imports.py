@@ -0,0 +1,519 @@
+import datetime
+import os
+from collections import OrderedDict
+from decimal import Decimal
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DecimalField, F, OuterRef, Subquery, Value, When
+
+from mediaset.shop.catalogue.models import Product, NewProductParameterValue
+from mediaset.shop.stock.models import StockRecord
+from mediaset.dashboard.transfer.caches import bump_catalogue_version, bump_product_version
+from mediaset.dashboard.transfer.columns import (
+    INVALID_PRICE, StockColumns, cents_to_price, price_cents, read_price_columns)
+from mediaset.dashboard.transfer.instrumentation import add_rows, phase
+from mediaset.dashboard.transfer.models import DataImport, PriceHistory, ProductPricesTransfer
+from mediaset.dashboard.transfer.fingerprints import PriceFingerprints
+from mediaset.dashboard.transfer.readers import UploadBook
+from mediaset.dashboard.transfer.reference import get_reference_data
+from mediaset.dashboard.transfer.utils import (
+    IMPORT_BATCH_SIZE, IMPORT_COMMIT_SIZE, batched, lookup_batches, normalize_code, ordered_map)
+
+
+STAGING_RETENTION_DAYS = getattr(settings, 'TRANSFER_STAGING_RETENTION_DAYS', 7)
+VALIDATION_WORKERS = getattr(settings, 'TRANSFER_VALIDATION_WORKERS', min(4, os.cpu_count() or 1))
+
+PRICE_HEADER = ['name', 'code', 'price']
+FULL_HEADER = ['name', 'code', 'first_text', 'price', 'provider', 'num_in_stock', 'destination']
+
+
+def existing_codes(codes):
+    existing = set()
+    with phase('resolve'):
+        for batch in lookup_batches(codes):
+            existing.update(Product.objects.filter(code__in=batch).values_list('code', flat=True))
+    return existing
+
+
+def resolve_product_ids(codes):
+    ids = {}
+    with phase('resolve'):
+        for batch in lookup_batches(codes):
+            ids.update(Product.objects.filter(code__in=batch).values_list('code', 'id'))
+    return ids
+
+
+def resolve_product_categories(codes):
+    """
+    Returns {code: category name} for existing products in a fixed number
+    of queries.
+    """
+    categories = {}
+    with phase('resolve'):
+        for batch in lookup_batches(codes):
+            categories.update(Product.objects.filter(code__in=batch).values_list('code', 'category__name'))
+    return categories
+
+
+class PriceBookValidator:
+    """
+    Validates a price book ((category name, rows) pairs from items())
+    sheet by sheet and batch by batch, and collects all errors instead of
+    stopping at the first one.
+    """
+    header = PRICE_HEADER
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, workers=VALIDATION_WORKERS):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.errors = []
+
+    def validate(self, book):
+        """
+        Validates the sheets concurrently in workers threads; errors are
+        collected in the order of the sheets.
+        """
+        for errors in ordered_map(lambda sheet: self.validate_sheet(*sheet),
+                                  read_price_columns(book, self.header), self.workers):
+            self.errors.extend(errors)
+        return self.errors
+
+    def validate_sheet(self, category_name, columns):
+        """
+        Returns the errors of one sheet.
+        """
+        errors = []
+        if columns.header != self.header:
+            errors.append('Лист {}: некорректные названия колонок. '
+                          'Убедитесь, что всего 3 колонки и их названия: name, code, price'.format(category_name))
+            return errors
+
+        seen = set()
+        # ordered like the first repetition of each code, with set lookups
+        duplicates = OrderedDict()
+        for start in range(0, len(columns), self.batch_size):
+            codes = columns.codes[start:start + self.batch_size]
+            categories = resolve_product_categories(set(codes))
+            add_rows(len(codes))
+
+            for index, code in enumerate(codes, start):
+                if code in seen:
+                    duplicates[code] = None
+                else:
+                    seen.add(code)
+
+                if code not in categories:
+                    errors.append('Товара с кодом {} не существует'.format(code))
+                elif categories[code] != category_name:
+                    errors.append('В категории {} не существует товара с кодом {}'.format(category_name, code))
+
+                if columns.cents[index] == INVALID_PRICE:
+                    errors.append('Товар с кодом {} имеет неверный формат цены'.format(code))
+
+        if duplicates:
+            errors.append('Обнаружено дублирование товаров с кодом: {}'.format(', '.join(duplicates)))
+        return errors
+
+
+def check_full_header(category_name, header):
+    """
+    Checks the header of a full import sheet and returns its parameter names.
+    """
+    with phase('validate'):
+        reference = get_reference_data()
+        if reference.category_id(category_name) is None:
+            raise ValueError('Категории {} не существует'.format(category_name))
+        if header[:len(FULL_HEADER)] != FULL_HEADER:
+            raise ValueError('Некорректные названия колонок. '
+                             'Убедитесь, что первых 7 колонок имеют названия: '
+                             'name, code, first_text, price, provider, num_in_stock, destination')
+        param_names = header[len(FULL_HEADER):]
+        for param in param_names:
+            if reference.parameter_id(category_name, param) is None:
+                raise ValueError('Не существует параметра {} в категории {}'.format(param, category_name))
+    return param_names
+
+
+class ImportCheckpoint:
+    """
+    Position of an import in its workbook: the sheet and the number of
+    its rows already committed. It is saved on the DataImport in the
+    transaction of every chunk, so a failed import resumes after the last
+    committed chunk.
+    """
+
+    def __init__(self, data_import):
+        self.data_import = data_import
+        self.reached = not data_import.checkpoint_sheet
+
+    def start(self, sheet):
+        """
+        Rows of sheet to skip, or None to skip the whole sheet.
+        """
+        if self.data_import.checkpoint_done:
+            return None
+        if self.reached:
+            return 0
+        if sheet != self.data_import.checkpoint_sheet:
+            return None
+        self.reached = True
+        return self.data_import.checkpoint_row
+
+    def save(self, sheet, row):
+        self.data_import.checkpoint_sheet = sheet
+        self.data_import.checkpoint_row = row
+        DataImport.objects.filter(pk=self.data_import.pk).update(checkpoint_sheet=sheet, checkpoint_row=row)
+
+    def finish(self):
+        self.data_import.checkpoint_done = True
+        DataImport.objects.filter(pk=self.data_import.pk).update(checkpoint_done=True)
+
+
+def iter_new_rows(book, batch_size=IMPORT_BATCH_SIZE, progress=None, checkpoint=None):
+    """
+    Yields (category name, parameter names, rows, position) for batches of
+    rows with the rows whose codes are not in the catalogue yet; position
+    is (sheet name, first row, end row) of the batch in its sheet. With a
+    checkpoint, the sheets and rows before it are skipped.
+    """
+    for category_name, rows in book.items():
+        start = 0 if checkpoint is None else checkpoint.start(category_name)
+        if start is not None:
+            yield from iter_new_sheet_rows(category_name, rows, batch_size, progress, start)
+
+
+def iter_new_sheet_rows(category_name, rows, batch_size=IMPORT_BATCH_SIZE, progress=None, start=0):
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return
+    param_names = check_full_header(category_name, header)
+    offset = start
+    for batch in batched(islice(rows, start, None), batch_size):
+        existing = existing_codes(set(normalize_code(row[1]) for row in batch))
+        new_rows = [row for row in batch if normalize_code(row[1]) not in existing]
+        add_rows(len(batch))
+        yield category_name, param_names, new_rows, (category_name, offset, offset + len(batch))
+        offset += len(batch)
+        if progress is not None:
+            progress.advance(len(batch))
+
+
+def find_sheet_new_objects(sheet):
+    """
+    Returns (category name, header, rows of unknown codes, errors) of one
+    full import sheet.
+    """
+    category_name, rows = sheet
+    header, new_rows = None, []
+    try:
+        for category_name, param_names, batch, position in iter_new_sheet_rows(category_name, rows):
+            header = FULL_HEADER + param_names
+            new_rows.extend(batch)
+    except ValueError as e:
+        return category_name, None, [], ['Лист {}: {}'.format(category_name, e)]
+    return category_name, header, new_rows, []
+
+
+def find_new_objects(book, workers=VALIDATION_WORKERS):
+    """
+    Returns {category name: rows} with the header and the rows of unknown
+    codes. Sheets are checked concurrently by workers threads and merged
+    in the order of the book; errors of all sheets are raised together as
+    one ValueError.
+    """
+    new_objects = {}
+    errors = []
+    for category_name, header, rows, sheet_errors in ordered_map(find_sheet_new_objects, book.items(), workers):
+        errors.extend(sheet_errors)
+        if rows:
+            new_objects.setdefault(category_name, [header]).extend(rows)
+    if errors:
+        raise ValueError('\n'.join(errors))
+    return new_objects
+
+
+def sweep_staging():
+    """
+    Removes staged prices older than TRANSFER_STAGING_RETENTION_DAYS.
+    """
+    date = datetime.date.today() - datetime.timedelta(days=STAGING_RETENTION_DAYS)
+    ProductPricesTransfer.objects.filter(date_on_add__lt=date).delete()
+
+
+def stage_prices(columns, data_import, progress=None):
+    """
+    Replaces the staged prices of data_import with the prices of
+    PriceColumns from a checked price file. Rows with invalid prices are
+    reported and skipped.
+    """
+    for code in columns.invalid_codes():
+        message = 'Товар с кодом {} содержит некорректные данные. ' \
+                  'Убедитесь в том, что в поле цена указано корректное число'.format(code)
+        if progress is None:
+            raise ValueError(message)
+        progress.error(message)
+
+    with phase('write'), transaction.atomic():
+        ProductPricesTransfer.objects.filter(data_import=data_import).delete()
+        for batch in batched(columns.prices().items(), IMPORT_BATCH_SIZE):
+            ProductPricesTransfer.objects.bulk_create([
+                ProductPricesTransfer(data_import=data_import, name='item', code=code,
+                                      product_price=cents_to_price(cents))
+                for code, cents in batch])
+            add_rows(len(batch))
+            if progress is not None:
+                progress.advance(len(batch))
+        sweep_staging()
+
+
+def iter_price_batches(sheets, batch_size=IMPORT_BATCH_SIZE, checkpoint=None):
+    """
+    Yields (sheet name, PriceColumns, position) for batches of batch_size
+    rows of (sheet name, PriceColumns) sheets; position is (sheet name,
+    first row, end row). With a checkpoint, the sheets and rows before it
+    are skipped.
+    """
+    for name, columns in sheets:
+        start = 0 if checkpoint is None else checkpoint.start(name)
+        if start is None:
+            continue
+        for offset in range(start, len(columns), batch_size):
+            end = min(offset + batch_size, len(columns))
+            yield name, columns.slice(offset, end), (name, offset, end)
+
+
+def stage_price_batch(columns, data_import):
+    """
+    Adds the valid prices of PriceColumns to the staged prices of
+    data_import, replacing staged prices of the same codes.
+    """
+    prices = columns.prices()
+    with phase('write'):
+        for batch in lookup_batches(prices.keys()):
+            ProductPricesTransfer.objects.filter(data_import=data_import, code__in=batch).delete()
+        ProductPricesTransfer.objects.bulk_create([
+            ProductPricesTransfer(data_import=data_import, name='item', code=code, product_price=cents_to_price(cents))
+            for code, cents in prices.items()], batch_size=IMPORT_BATCH_SIZE)
+    add_rows(len(prices))
+
+
+def remember_file_prices(data_import):
+    """
+    Stores the valid prices of every row of the file of data_import as the
+    last imported prices of its stream, not only the posted ones, so the
+    next file of the stream shows just the rows that changed since. Called
+    when prices are applied: staged prices may still be dropped.
+    """
+    if not data_import.stream:
+        return
+    prices = {}
+    for name, columns in read_price_columns(UploadBook(data_import), PRICE_HEADER):
+        prices.update(columns.prices())
+    PriceFingerprints.for_stream(data_import.stream).update(prices)
+
+
+def changed_prices(data_import):
+    """
+    StockRecords whose price differs from the price staged by data_import,
+    annotated with new_price and ordered by product code. The staging table
+    is joined in the same query.
+    """
+    staged = ProductPricesTransfer.objects.filter(data_import=data_import, code=OuterRef('product__code'))
+    return (StockRecord.objects
+            .annotate(new_price=Subquery(staged.values('product_price')[:1]))
+            .filter(new_price__isnull=False)
+            .exclude(price=F('new_price'))
+            .order_by('product__code'))
+
+
+def update_stock_prices(prices, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Sets prices from [(stock record id, price), ...] with one UPDATE per
+    batch; a price of None clears the price.
+    """
+    for batch in batched(prices, batch_size):
+        cleared = [pk for pk, price in batch if price is None]
+        if cleared:
+            StockRecord.objects.filter(pk__in=cleared).update(price=None)
+        batch = [(pk, price) for pk, price in batch if price is not None]
+        if batch:
+            StockRecord.objects.filter(pk__in=[pk for pk, price in batch]).update(price=Case(
+                *[When(pk=pk, then=Value(price)) for pk, price in batch],
+                output_field=DecimalField()))
+
+
+def apply_prices(columns, data_import=None, progress=None, remember=True, history=None):
+    """
+    Sets StockRecord prices from PriceColumns in one transaction and
+    stores the old and new prices as one PriceHistory entry, or adds them
+    to history; nothing is stored when no price changed. With remember,
+    the prices of the whole file of data_import are stored for its stream,
+    see remember_file_prices.
+    """
+    invalid = columns.invalid_codes()
+    if invalid:
+        raise ValueError('Товар с кодом {} имеет неверный формат цены'.format(invalid[0]))
+    new_prices = columns.prices()
+
+    with transaction.atomic():
+        changes = []
+        for batch in lookup_batches(new_prices.keys(), 'product__code'):
+            with phase('resolve'):
+                records = list(StockRecord.objects.filter(
+                    product__code__in=batch).values_list('id', 'product__code', 'price'))
+            for pk, code, price in records:
+                if price is None or price_cents(price) != new_prices[code]:
+                    changes.append((pk, price, cents_to_price(new_prices[code])))
+            add_rows(len(batch))
+            if progress is not None:
+                progress.advance(len(batch))
+
+        if history is None:
+            history = PriceHistory(data_import=data_import)
+        with phase('write'):
+            if changes:
+                update_stock_prices([(pk, new) for pk, old, new in changes])
+                transaction.on_commit(bump_catalogue_version)
+                history.add_changes(changes)
+                history.save()
+            if data_import is not None and remember:
+                remember_file_prices(data_import)
+    return history
+
+
+def rollback_prices(history):
+    """
+    Restores the prices changed by a PriceHistory entry.
+    """
+    with transaction.atomic():
+        update_stock_prices([(pk, None if old is None else Decimal(old)) for pk, old, new in history.get_changes()])
+        transaction.on_commit(bump_catalogue_version)
+        history.rolled_back = True
+        history.save(update_fields=['rolled_back'])
+
+
+def commit_in_chunks(batches, handle, commit_size=IMPORT_COMMIT_SIZE, checkpoint=None):
+    """
+    Calls handle(batch) for batches whose last item is their (sheet name,
+    first row, end row) position. Every commit_size rows handled are
+    committed in their own transaction together with the checkpoint, if
+    one is given; without commit_size all batches are one transaction.
+    Batches are read one at a time, so each one is read after the batches
+    before it were written.
+    """
+    batches = iter(batches)
+    done = False
+    while not done:
+        with transaction.atomic():
+            rows, position, done = 0, None, True
+            for batch in batches:
+                handle(batch)
+                position = batch[-1]
+                rows += position[2] - position[1]
+                if commit_size and rows >= commit_size:
+                    done = False
+                    break
+            if checkpoint is not None and position is not None:
+                checkpoint.save(position[0], position[2])
+    if checkpoint is not None:
+        checkpoint.finish()
+
+
+class ProductImportPipeline:
+    """
+    Creates new products from (category name, parameter names, rows,
+    position) batches, see iter_new_rows. Products, stock records,
+    destinations and parameter values of a batch are built in memory and
+    written with bulk_create. Batches are committed every commit_size
+    rows together with the checkpoint, see commit_in_chunks.
+    """
+
+    def __init__(self, default_provider, batch_size=IMPORT_BATCH_SIZE, commit_size=IMPORT_COMMIT_SIZE):
+        self.default_provider = str(default_provider)
+        self.batch_size = batch_size
+        self.commit_size = commit_size
+        self.created = 0
+
+    def run(self, batches, checkpoint=None):
+        self.reference = get_reference_data()
+        self.default_provider_id = self.reference.provider_id(self.default_provider)
+        if self.default_provider_id is None:
+            raise ValueError('Поставщика {} не существует'.format(self.default_provider))
+        commit_in_chunks(batches, self.import_batch, self.commit_size, checkpoint)
+        return self.created
+
+    def import_batch(self, batch):
+        category_name, param_names, rows, position = batch
+        if rows:
+            self.import_rows(category_name, param_names, rows)
+
+    def import_rows(self, category_name, param_names, rows):
+        # rows were checked against the catalogue when their batch was
+        # read, after the batches before it were written
+        category_id = self.reference.category_id(category_name)
+        new_rows = {}
+        for row in rows:
+            new_rows.setdefault(normalize_code(row[1]), row)
+
+        with phase('write'):
+            Product.objects.bulk_create(
+                [Product(name=row[0], code=code, category_id=category_id, first_text=row[2])
+                 for code, row in new_rows.items()],
+                batch_size=self.batch_size)
+        product_ids = resolve_product_ids(new_rows.keys())
+
+        with phase('write'):
+            self.create_stock_records(new_rows, product_ids)
+            self.create_destinations(new_rows, product_ids)
+            if param_names:
+                self.create_parameter_values(category_name, param_names, new_rows, product_ids)
+            # bulk_create sends no post_save signals
+            transaction.on_commit(bump_catalogue_version)
+            transaction.on_commit(bump_product_version)
+        self.created += len(new_rows)
+
+    def create_stock_records(self, new_rows, product_ids):
+        columns = StockColumns(new_rows.values())
+        invalid = columns.invalid_codes()
+        if invalid:
+            raise ValueError('Товар с кодом {} имеет неверный формат цены'.format(invalid[0]))
+        StockRecord.objects.bulk_create(
+            [StockRecord(product_id=product_ids[code], price=cents_to_price(cents),
+                         provider_id=self.reference.provider_id(provider, self.default_provider_id),
+                         num_in_stock=num_in_stock)
+             for code, cents, provider, num_in_stock in zip(
+                columns.codes, columns.cents, columns.providers, columns.num_in_stock)],
+            batch_size=self.batch_size)
+
+    def create_destinations(self, new_rows, product_ids):
+        destinations = {code: row[6].split(', ') for code, row in new_rows.items() if row[6]}
+        if not destinations:
+            return
+        field = Product._meta.get_field('destination')
+        through = field.remote_field.through
+        product_field = '{}_id'.format(field.m2m_field_name())
+        car_model_field = '{}_id'.format(field.m2m_reverse_field_name())
+
+        links = []
+        for code, values in destinations.items():
+            for value in set(values):
+                car_model_id = self.reference.car_model_id(value)
+                if car_model_id is not None:
+                    links.append(through(**{product_field: product_ids[code], car_model_field: car_model_id}))
+        through.objects.bulk_create(links, batch_size=self.batch_size)
+
+    def create_parameter_values(self, category_name, param_names, new_rows, product_ids):
+        parameters = {name: self.reference.parameter_id(category_name, name) for name in param_names}
+        values = self.reference.parameter_values(pk for pk in parameters.values() if pk is not None)
+
+        parameter_values = []
+        for code, row in new_rows.items():
+            for name, value in zip(param_names, row[len(FULL_HEADER):]):
+                key = (parameters.get(name), str(value))
+                if value and key in values:
+                    parameter_values.append(NewProductParameterValue(
+                        product_id=product_ids[code], parameter_id=key[0], value_id=values[key]))
+        NewProductParameterValue.objects.bulk_create(parameter_values, batch_size=self.batch_size)
@@ -0,0 +1,270 @@
+import cProfile
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from contextlib import ExitStack, contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+from mediaset.dashboard.transfer.caches import CACHE_ROOT
+
+
+HISTORY_SIZE = getattr(settings, 'TRANSFER_INSTRUMENTATION_HISTORY', 100)
+PROFILE_DIR = getattr(settings, 'TRANSFER_PROFILE_DIR', os.path.join(CACHE_ROOT, 'profiles'))
+
+logger = logging.getLogger(__name__)
+
+recent_traces = deque(maxlen=HISTORY_SIZE)
+_local = threading.local()
+
+
+class CountingCursor:
+    """
+    Cursor wrapper that counts the queries it runs in the counters
+    installed on its connection, see QueryCounter.install.
+    """
+
+    def __init__(self, cursor, counters):
+        self.cursor = cursor
+        self.counters = counters
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.cursor.__exit__(*exc_info)
+
+    def count(self):
+        for counter in list(self.counters):
+            counter.add()
+
+    def callproc(self, *args, **kwargs):
+        self.count()
+        return self.cursor.callproc(*args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        self.count()
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self.count()
+        return self.cursor.executemany(*args, **kwargs)
+
+
+def query_counters(conn):
+    """
+    Returns the list of counters of conn, making its cursors count their
+    queries in them on first use. For Django versions without
+    connection.execute_wrapper.
+    """
+    counters = conn.__dict__.get('transfer_query_counters')
+    if counters is None:
+        counters = conn.transfer_query_counters = []
+        make_cursor, make_debug_cursor = conn.make_cursor, conn.make_debug_cursor
+        conn.make_cursor = lambda cursor: CountingCursor(make_cursor(cursor), counters)
+        conn.make_debug_cursor = lambda cursor: CountingCursor(make_debug_cursor(cursor), counters)
+    return counters
+
+
+class QueryCounter:
+    """
+    Counts the queries run on the connections of the threads it is
+    installed in. Uses connection.execute_wrapper where Django has it and
+    wraps the cursors of the connection otherwise.
+    """
+
+    def __init__(self):
+        self.executed = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.add()
+        return execute(sql, params, many, context)
+
+    def add(self):
+        with self.lock:
+            self.executed += 1
+
+    @property
+    def count(self):
+        with self.lock:
+            return self.executed
+
+    @contextmanager
+    def install(self):
+        if hasattr(connection, 'execute_wrapper'):
+            with connection.execute_wrapper(self):
+                yield
+            return
+        counters = query_counters(connections[DEFAULT_DB_ALIAS])
+        counters.append(self)
+        try:
+            yield
+        finally:
+            counters.remove(self)
+
+
+class Trace:
+    def __init__(self, name, **extra):
+        self.name = name
+        self.extra = extra
+        self.started = time.monotonic()
+        self.date = datetime.datetime.now()
+        self.phases = OrderedDict()
+        self.rows = 0
+        self.error = None
+        self.profile_path = None
+        self.queries = QueryCounter()
+        self.lock = threading.Lock()
+        self.parent = None
+
+    def to_dict(self):
+        seconds = time.monotonic() - self.started
+        return {
+            'name': self.name,
+            'date': self.date.isoformat(),
+            'seconds': round(seconds, 4),
+            'queries': self.queries.count,
+            'rows': self.rows,
+            'rows_per_second': round(self.rows / seconds, 1) if seconds > 0 else 0,
+            'phases': self.phases,
+            'error': self.error,
+            'profile': self.profile_path,
+            **self.extra,
+        }
+
+    def summary(self):
+        data = self.to_dict()
+        lines = ['{rows} rows in {seconds}s, {rows_per_second} rows/s, {queries} queries'.format(**data)]
+        for name, values in self.phases.items():
+            lines.append('  {:<10} {seconds}s, {queries} queries'.format(name, **values))
+        return '\n'.join(lines)
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def trace(name, **extra):
+    """
+    Records timings, query counts and rows of one import or export. The
+    record is logged as json and kept in recent_traces.
+    """
+    record = Trace(name, **extra)
+    previous = current_trace()
+    record.parent = previous
+    _local.trace = record
+    try:
+        with record.queries.install():
+            yield record
+    except Exception as e:
+        record.error = str(e)
+        raise
+    finally:
+        _local.trace = previous
+        data = record.to_dict()
+        recent_traces.append(data)
+        logger.info(json.dumps(data, default=str), extra={'transfer_trace': data})
+
+
+@contextmanager
+def phase(name):
+    record = current_trace()
+    if record is None:
+        yield
+        return
+    started = time.monotonic()
+    queries = record.queries.count
+    try:
+        yield
+    finally:
+        queries = record.queries.count - queries
+        with record.lock:
+            data = record.phases.setdefault(name, {'seconds': 0, 'queries': 0})
+            data['seconds'] = round(data['seconds'] + time.monotonic() - started, 4)
+            data['queries'] += queries
+
+
+def add_rows(rows):
+    record = current_trace()
+    if record is not None:
+        with record.lock:
+            record.rows += rows
+
+
+def in_trace(func):
+    """
+    Wraps func to run in the trace of the calling thread, for work handed
+    over to other threads: their queries, phases and rows are recorded
+    in that trace too. Queries also count towards the enclosing traces,
+    as they do on the calling thread.
+    """
+    record = current_trace()
+    if record is None:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current_trace()
+        _local.trace = record
+        try:
+            with ExitStack() as stack:
+                enclosing = record
+                while enclosing is not None:
+                    stack.enter_context(enclosing.queries.install())
+                    enclosing = enclosing.parent
+                return func(*args, **kwargs)
+        finally:
+            _local.trace = previous
+    return wrapper
+
+
+def instrument(name):
+    """
+    View decorator that traces the request. Staff users can add ?profile=1
+    to capture a cProfile dump of that single request into
+    TRANSFER_PROFILE_DIR; its path is stored in the trace.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            with trace(name, method=request.method) as record:
+                if request.GET.get('profile') == '1' and request.user.is_staff:
+                    return profile(record, view, request, *args, **kwargs)
+                return render(view(request, *args, **kwargs))
+        return wrapper
+
+    return decorator
+
+
+def render(response):
+    # template responses are rendered after the view returns
+    if hasattr(response, 'render') and not response.is_rendered:
+        with phase('render'):
+            response.render()
+    return response
+
+
+def profile(record, view, request, *args, **kwargs):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(lambda: render(view(request, *args, **kwargs)))
+    finally:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        record.profile_path = os.path.join(
+            PROFILE_DIR, '{}-{}.prof'.format(record.name, record.date.strftime('%Y%m%d-%H%M%S-%f')))
+        profiler.dump_stats(record.profile_path)
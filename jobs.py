@@ -0,0 +1,216 @@
+import datetime
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from mediaset.dashboard.transfer.models import DataImport, ImportJob
+from mediaset.dashboard.transfer.columns import PriceColumns
+from mediaset.dashboard.transfer.instrumentation import trace
+from mediaset.dashboard.transfer.imports import (
+    ImportCheckpoint, ProductImportPipeline, apply_prices, iter_new_rows, stage_prices)
+from mediaset.dashboard.transfer.readers import UploadBook
+
+
+IMPORT_WORKERS = getattr(settings, 'TRANSFER_IMPORT_WORKERS', 2)
+PROGRESS_INTERVAL = getattr(settings, 'TRANSFER_JOB_PROGRESS_INTERVAL', 1.0)
+HEARTBEAT_TIMEOUT = getattr(settings, 'TRANSFER_JOB_HEARTBEAT_TIMEOUT', 5 * 60)
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_active_jobs = set()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=IMPORT_WORKERS)
+            threading.Thread(target=heartbeat, name='transfer-job-heartbeat', daemon=True).start()
+    return _executor
+
+
+def progress_cache_key(job_id):
+    return 'transfer:import-job:{}'.format(job_id)
+
+
+def heartbeat_cache_key(job_id):
+    return 'transfer:import-job-heartbeat:{}'.format(job_id)
+
+
+def beat(job_ids):
+    cache.set_many({heartbeat_cache_key(job_id): 1 for job_id in job_ids}, timeout=HEARTBEAT_TIMEOUT)
+
+
+def heartbeat():
+    """
+    Keeps the heartbeat keys of the jobs queued or running in this process
+    alive. When the process dies the keys expire and the jobs count as
+    interrupted, see is_alive.
+    """
+    while True:
+        with _executor_lock:
+            job_ids = list(_active_jobs)
+        if job_ids:
+            beat(job_ids)
+        time.sleep(HEARTBEAT_TIMEOUT / 3)
+
+
+def is_alive(job):
+    """
+    Tells whether a pending or running job is still queued or running in
+    some process. Jobs just created may not have a heartbeat yet.
+    """
+    if cache.get(heartbeat_cache_key(job.id)) is not None:
+        return True
+    return (job.status == ImportJob.STATUS_PENDING and
+            job.creation_date > timezone.now() - datetime.timedelta(seconds=HEARTBEAT_TIMEOUT))
+
+
+def submit(job_id, task, args, kwargs):
+    executor = get_executor()
+    with _executor_lock:
+        _active_jobs.add(job_id)
+    beat([job_id])
+    executor.submit(run_job, job_id, task, args, kwargs)
+
+
+class JobProgress:
+    """
+    Collects progress of a running job. Imports write inside a transaction,
+    so live counters are published through the cache and stored on the job
+    row only when it finishes.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.rows_total = 0
+        self.rows_processed = 0
+        self.errors = []
+        self.last_publish = 0
+
+    def set_total(self, rows_total):
+        self.rows_total = rows_total
+        self.publish()
+
+    def advance(self, rows=1):
+        self.rows_processed += rows
+        if time.monotonic() - self.last_publish >= PROGRESS_INTERVAL:
+            self.publish()
+
+    def error(self, message):
+        self.errors.append(str(message))
+        self.publish()
+
+    def publish(self):
+        self.last_publish = time.monotonic()
+        cache.set(progress_cache_key(self.job.id), {
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed,
+            'errors': self.errors,
+        }, timeout=24 * 60 * 60)
+
+
+def get_job_status(job):
+    status = job.to_dict()
+    if job.status == ImportJob.STATUS_RUNNING:
+        live = cache.get(progress_cache_key(job.id))
+        if live:
+            status.update(live)
+            status['rows_per_second'] = job.get_rows_per_second(live['rows_processed'])
+    return status
+
+
+def run_job(job_id, task, args, kwargs):
+    close_old_connections()
+    try:
+        job = ImportJob.objects.get(pk=job_id)
+        job.status = ImportJob.STATUS_RUNNING
+        job.start_date = timezone.now()
+        job.save(update_fields=['status', 'start_date'])
+
+        progress = JobProgress(job)
+        try:
+            with trace('job_{}'.format(job.kind), job=job.id):
+                task(progress, *args, **kwargs)
+        except Exception as e:
+            logger.exception('Import job %s failed', job_id)
+            progress.errors.append(str(e))
+            job.status = ImportJob.STATUS_FAILED
+        else:
+            job.status = ImportJob.STATUS_DONE
+
+        job.rows_total = max(progress.rows_total, progress.rows_processed)
+        job.rows_processed = progress.rows_processed
+        job.errors = '\n'.join(progress.errors)
+        job.finish_date = timezone.now()
+        job.save()
+        cache.delete(progress_cache_key(job_id))
+    finally:
+        with _executor_lock:
+            _active_jobs.discard(job_id)
+        cache.delete(heartbeat_cache_key(job_id))
+        connection.close()
+
+
+def enqueue(kind, task, *args, data_import=None, **kwargs):
+    """
+    Creates an ImportJob and runs task(progress, *args, **kwargs) in the
+    worker pool once the current transaction is committed.
+    """
+    job = ImportJob.objects.create(kind=kind, data_import=data_import)
+    transaction.on_commit(lambda: submit(job.id, task, args, kwargs))
+    return job
+
+
+def enqueue_once(kind, task, *args, data_import, **kwargs):
+    """
+    Like enqueue, but returns None instead of a new job while a job of
+    data_import is pending or running. The import row stays locked until
+    the job is created, so concurrent requests cannot both start one.
+    Jobs whose process was killed are marked as failed, so the import can
+    be resumed.
+    """
+    with transaction.atomic():
+        DataImport.objects.select_for_update().get(pk=data_import.pk)
+        for job in ImportJob.objects.filter(data_import=data_import,
+                                            status__in=[ImportJob.STATUS_PENDING, ImportJob.STATUS_RUNNING]):
+            if is_alive(job):
+                return None
+            logger.warning('Import job %s was interrupted', job.id)
+            job.status = ImportJob.STATUS_FAILED
+            job.errors = 'Задача прервана'
+            job.finish_date = timezone.now()
+            job.save(update_fields=['status', 'errors', 'finish_date'])
+        return enqueue(kind, task, *args, data_import=data_import, **kwargs)
+
+
+def full_import_task(progress, data_import_id, default_provider):
+    """
+    Imports the new products of a full import file, resuming after the
+    last committed chunk if the import was interrupted before.
+    """
+    data_import = DataImport.objects.get(pk=data_import_id)
+    book = UploadBook(data_import)
+    checkpoint = ImportCheckpoint(data_import)
+    progress.set_total(book.row_count())
+    ProductImportPipeline(default_provider).run(
+        iter_new_rows(book, progress=progress, checkpoint=checkpoint), checkpoint)
+
+
+def price_staging_task(progress, prices, data_import_id):
+    progress.set_total(len(prices))
+    stage_prices(PriceColumns.from_mapping(prices), DataImport.objects.get(pk=data_import_id), progress=progress)
+
+
+def price_apply_task(progress, prices, data_import_id=None):
+    progress.set_total(len(prices))
+    data_import = DataImport.objects.filter(pk=data_import_id).first()
+    apply_prices(PriceColumns.from_mapping(prices), data_import=data_import, progress=progress)
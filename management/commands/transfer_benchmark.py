@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from mediaset.dashboard.transfer.benchmarks import compare, run_benchmarks
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks transfer imports and exports on synthetic catalogues in a throwaway SQLite test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000],
+                            help='Catalogue and workbook sizes, e.g. --rows 1000 10000 100000')
+        parser.add_argument('--output', help='Write results as json to this file')
+        parser.add_argument('--baseline', help='Compare timings with results written by an earlier run')
+        parser.add_argument('--any-database', action='store_true',
+                            help='Allow running on a database backend other than SQLite')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite' and not options['any_database']:
+            raise CommandError('Benchmarks run on SQLite, use settings with a SQLite database '
+                               'or pass --any-database')
+
+        directory = tempfile.mkdtemp(prefix='transfer_benchmark_')
+        # catalogue versions, build locks and cached files of the benchmark
+        # stay apart from the ones of the running site
+        isolated = override_settings(
+            MEDIA_ROOT=os.path.join(directory, 'media'),
+            TRANSFER_CACHE_ROOT=os.path.join(directory, 'cache'),
+            CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'LOCATION': os.path.basename(directory),
+                'KEY_PREFIX': os.path.basename(directory),
+            }})
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        results = []
+        try:
+            with isolated:
+                for rows in options['rows']:
+                    call_command('flush', interactive=False, verbosity=0)
+                    for result in run_benchmarks(rows, directory):
+                        results.append(result)
+                        self.stdout.write(
+                            '{scenario:<16} {rows:>7} rows {seconds:>9.3f}s {rows_per_second:>10.1f} rows/s '
+                            '{queries:>6} queries (budget {query_budget})'.format(**result))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+            for scenario, rows, seconds, old_seconds, ratio in compare(results, baseline):
+                self.stdout.write('{:<16} {:>7} rows {:>9.3f}s, baseline {:>9.3f}s, x{}'.format(
+                    scenario, rows, seconds, old_seconds, ratio))
+
+        over_budget = [result for result in results if not result['within_budget']]
+        if over_budget:
+            raise CommandError('Query budget exceeded: {}'.format(', '.join(
+                '{scenario} ({rows} rows): {queries} > {query_budget}'.format(**result) for result in over_budget)))
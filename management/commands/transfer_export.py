@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mediaset.shop.catalogue.models import Category
+from mediaset.dashboard.transfer.exports import (
+    EXPORT_CHUNK_SIZE, EXPORT_WORKERS, ExportFilter, blank_sheets, parse_since, price_sheets, product_sheets,
+    write_csv, write_xlsx)
+from mediaset.dashboard.transfer.instrumentation import trace
+
+
+class Command(BaseCommand):
+    help = 'Writes the prices, products or blank export to a file without going through the dashboard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=['prices', 'products', 'blank'])
+        parser.add_argument('path', help='Output file')
+        parser.add_argument('--format', choices=['xlsx', 'csv'], default='xlsx')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help='Products loaded per query')
+        parser.add_argument('--workers', type=int, default=EXPORT_WORKERS,
+                            help='Chunks of a sheet built concurrently')
+        parser.add_argument('--since', help='Only products or stock records modified since this ISO date or time')
+        parser.add_argument('--code', default='', help='Only products whose code contains this text')
+        parser.add_argument('--name', default='', help='Only products whose name contains this text')
+        parser.add_argument('--category', help='Only products of the category with this name')
+
+    def handle(self, *args, **options):
+        try:
+            category = Category.objects.get(name=options['category']) if options['category'] else None
+            export_filter = ExportFilter(code=options['code'], name=options['name'], category=category,
+                                         since=parse_since(options['since']))
+        except Category.DoesNotExist:
+            raise CommandError('Категории {} не существует'.format(options['category']))
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        with trace('command_export_{}'.format(options['kind'])) as record:
+            if options['kind'] == 'blank':
+                sheets = blank_sheets(export_filter=export_filter)
+            else:
+                sheets_func = price_sheets if options['kind'] == 'prices' else product_sheets
+                sheets = sheets_func(workers=options['workers'], chunk_size=options['chunk_size'],
+                                     export_filter=export_filter)
+            writer = write_csv if options['format'] == 'csv' else write_xlsx
+            with open(options['path'], 'wb') as f:
+                writer(sheets, f)
+            self.stdout.write(record.summary())
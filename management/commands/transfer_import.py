@@ -0,0 +1,52 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mediaset.dashboard.transfer.imports import ImportCheckpoint, ProductImportPipeline, iter_new_rows
+from mediaset.dashboard.transfer.instrumentation import trace
+from mediaset.dashboard.transfer.models import DataImport
+from mediaset.dashboard.transfer.readers import UploadBook, create_data_import
+from mediaset.dashboard.transfer.utils import IMPORT_BATCH_SIZE, IMPORT_COMMIT_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Imports new products from a full import workbook (.xlsx) without going through the dashboard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Workbook with one sheet per category')
+        parser.add_argument('--resume', type=int, metavar='IMPORT_ID',
+                            help='Continue an interrupted import from its last checkpoint instead of reading path')
+        parser.add_argument('--provider', default=str(settings.COMPANY),
+                            help='Provider of stock records whose provider column is unknown')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help='Rows checked and written per batch')
+        parser.add_argument('--commit-size', type=int, default=IMPORT_COMMIT_SIZE,
+                            help='Rows read per transaction and checkpoint')
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            try:
+                data_import = DataImport.objects.get(pk=options['resume'])
+            except DataImport.DoesNotExist:
+                raise CommandError('Импорта №{} не существует'.format(options['resume']))
+            if data_import.checkpoint_sheet:
+                self.stdout.write('Продолжение с листа {}, строки {}'.format(
+                    data_import.checkpoint_sheet, data_import.checkpoint_row + 1))
+        elif options['path']:
+            data_import = create_data_import(options['path'], name='new_import_all')
+        else:
+            raise CommandError('Укажите файл или --resume')
+
+        book = UploadBook(data_import, batch_size=options['batch_size'])
+        checkpoint = ImportCheckpoint(data_import)
+        pipeline = ProductImportPipeline(
+            options['provider'], batch_size=options['batch_size'], commit_size=options['commit_size'])
+
+        with trace('command_import', data_import=data_import.id) as record:
+            try:
+                created = pipeline.run(
+                    iter_new_rows(book, batch_size=options['batch_size'], checkpoint=checkpoint), checkpoint)
+            except ValueError as e:
+                raise CommandError('{} (создано товаров: {}, продолжить: --resume {})'.format(
+                    e, pipeline.created, data_import.id))
+            self.stdout.write('Импорт №{}: создано товаров: {}'.format(data_import.id, created))
+            self.stdout.write(record.summary())
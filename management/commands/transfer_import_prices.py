@@ -0,0 +1,85 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mediaset.dashboard.transfer.columns import read_price_columns
+from mediaset.dashboard.transfer.fingerprints import IncrementalPriceBook, PriceFingerprints
+from mediaset.dashboard.transfer.imports import (
+    PRICE_HEADER, ImportCheckpoint, PriceBookValidator, apply_prices, commit_in_chunks, iter_price_batches,
+    remember_file_prices, stage_price_batch)
+from mediaset.dashboard.transfer.instrumentation import trace
+from mediaset.dashboard.transfer.models import DataImport, PriceHistory, ProductPricesTransfer
+from mediaset.dashboard.transfer.readers import UploadBook, create_data_import
+from mediaset.dashboard.transfer.utils import IMPORT_BATCH_SIZE, IMPORT_COMMIT_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Checks and stages the prices of a price workbook (.xlsx), and with --apply sets them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Workbook with one sheet per category')
+        parser.add_argument('--resume', type=int, metavar='IMPORT_ID',
+                            help='Continue an interrupted import from its last checkpoint instead of reading path')
+        parser.add_argument('--stream', default='',
+                            help='Supplier file stream; rows unchanged since its last import are skipped')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE,
+                            help='Rows checked and written per batch')
+        parser.add_argument('--commit-size', type=int, default=IMPORT_COMMIT_SIZE,
+                            help='Rows staged (and applied) per transaction and checkpoint')
+        parser.add_argument('--apply', action='store_true',
+                            help='Set the changed prices instead of leaving them staged for review')
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            try:
+                data_import = DataImport.objects.get(pk=options['resume'])
+            except DataImport.DoesNotExist:
+                raise CommandError('Импорта №{} не существует'.format(options['resume']))
+            if data_import.checkpoint_sheet:
+                self.stdout.write('Продолжение с листа {}, строки {}'.format(
+                    data_import.checkpoint_sheet, data_import.checkpoint_row + 1))
+        elif options['path']:
+            data_import = create_data_import(options['path'], stream=options['stream'])
+        else:
+            raise CommandError('Укажите файл или --resume')
+
+        book = UploadBook(data_import, batch_size=options['batch_size'])
+        if data_import.stream:
+            book = IncrementalPriceBook(book, PriceFingerprints.for_stream(data_import.stream))
+
+        with trace('command_import_prices', data_import=data_import.id) as record:
+            try:
+                errors = PriceBookValidator(batch_size=options['batch_size']).validate(book)
+            except ValueError as e:
+                raise CommandError(str(e))
+            if errors:
+                raise CommandError('\n'.join(errors))
+
+            checkpoint = ImportCheckpoint(data_import)
+            # the changes of all batches go to one history entry, also when resumed
+            history = None
+            if data_import.checkpoint_sheet:
+                history = PriceHistory.objects.filter(data_import=data_import, rolled_back=False).first()
+            else:
+                ProductPricesTransfer.objects.filter(data_import=data_import).delete()
+            state = {'staged': 0, 'history': history}
+
+            def handle_batch(batch):
+                category_name, columns, position = batch
+                stage_price_batch(columns, data_import)
+                state['staged'] += len(columns)
+                if options['apply']:
+                    state['history'] = apply_prices(columns, data_import=data_import, remember=False,
+                                                    history=state['history'])
+
+            batches = iter_price_batches(
+                read_price_columns(book, PRICE_HEADER), options['batch_size'], checkpoint)
+            try:
+                commit_in_chunks(batches, handle_batch, options['commit_size'], checkpoint)
+            except ValueError as e:
+                raise CommandError('{} (продолжить: --resume {})'.format(e, data_import.id))
+            if options['apply']:
+                remember_file_prices(data_import)
+
+            self.stdout.write('Импорт №{}: загружено цен: {}'.format(data_import.id, state['staged']))
+            if options['apply']:
+                self.stdout.write('Обновлено цен: {}'.format(state['history'].changes_count if state['history'] else 0))
+            self.stdout.write(record.summary())
@@ -1,4 +1,8 @@
+import json
+from collections import OrderedDict
+
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import pgettext_lazy, ugettext_lazy as _
 from django.core.urlresolvers import reverse
 
@@ -9,6 +13,12 @@ class DataImport(models.Model):
     last_edit_date = models.DateField(_('Updated date'), auto_now=True, blank=True, null=True)
     weight = models.PositiveIntegerField(_('Weight of import'), default=0)
     upload = models.FileField(_('Import file'), upload_to='import/')
+    content_hash = models.CharField(_('Content hash'), max_length=40, blank=True, db_index=True)
+    stream = models.CharField(_('Supplier file stream'), max_length=256, blank=True,
+                              help_text=_('Price rows unchanged since the last import of this stream are skipped'))
+    checkpoint_sheet = models.CharField(_('Checkpoint sheet'), max_length=256, blank=True)
+    checkpoint_row = models.PositiveIntegerField(_('Checkpoint row'), default=0)
+    checkpoint_done = models.BooleanField(_('Imported'), default=False)
 
     def __str__(self):
         return self.name
@@ -25,8 +35,10 @@ class DataImport(models.Model):
 
 
 class ProductPricesTransfer(models.Model):
+    data_import = models.ForeignKey(DataImport, verbose_name=_('Data Import'), related_name='price_transfers',
+                                    blank=True, null=True, on_delete=models.CASCADE)
     name = models.CharField(_('Product name'), max_length=256)
-    code = models.CharField(_('Code'), max_length=256, unique=True, blank=True, null=True)
+    code = models.CharField(_('Code'), max_length=256, blank=True, null=True)
     product_price = models.DecimalField(_("Import Price"), decimal_places=2, max_digits=12, blank=True, null=True)
     date_on_add = models.DateField(_('Created date'), auto_now_add=True, blank=True, null=True)
 
@@ -43,5 +55,121 @@ class ProductPricesTransfer(models.Model):
     #     return book
 
     class Meta:
+        unique_together = ('data_import', 'code')
         verbose_name = _('Product Price Transfer')
         verbose_name_plural = _('Product Price Transfers')
+
+
+class ImportJob(models.Model):
+    KIND_FULL = 'full'
+    KIND_PRICES = 'prices'
+    KIND_APPLY_PRICES = 'apply_prices'
+    KIND_CHOICES = (
+        (KIND_FULL, _('Full import')),
+        (KIND_PRICES, _('Price import')),
+        (KIND_APPLY_PRICES, _('Price update')),
+    )
+
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _('Pending')),
+        (STATUS_RUNNING, _('Running')),
+        (STATUS_DONE, _('Done')),
+        (STATUS_FAILED, _('Failed')),
+    )
+
+    data_import = models.ForeignKey(DataImport, verbose_name=_('Data Import'), related_name='jobs',
+                                    blank=True, null=True, on_delete=models.CASCADE)
+    kind = models.CharField(_('Kind'), max_length=32, choices=KIND_CHOICES)
+    status = models.CharField(_('Status'), max_length=32, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    rows_total = models.PositiveIntegerField(_('Rows total'), default=0)
+    rows_processed = models.PositiveIntegerField(_('Rows processed'), default=0)
+    errors = models.TextField(_('Errors'), blank=True)
+    creation_date = models.DateTimeField(_('Created date'), auto_now_add=True)
+    start_date = models.DateTimeField(_('Started date'), blank=True, null=True)
+    finish_date = models.DateTimeField(_('Finished date'), blank=True, null=True)
+
+    def __str__(self):
+        return '{} #{}'.format(self.get_kind_display(), self.id)
+
+    def get_errors(self):
+        return [error for error in self.errors.split('\n') if error]
+
+    def get_rows_per_second(self, rows_processed=None):
+        if not self.start_date:
+            return 0
+        rows_processed = self.rows_processed if rows_processed is None else rows_processed
+        seconds = ((self.finish_date or timezone.now()) - self.start_date).total_seconds()
+        return round(rows_processed / seconds, 1) if seconds > 0 else 0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'data_import': self.data_import_id,
+            'kind': self.kind,
+            'status': self.status,
+            'rows_total': self.rows_total,
+            'rows_processed': self.rows_processed,
+            'rows_per_second': self.get_rows_per_second(),
+            'errors': self.get_errors(),
+            'creation_date': self.creation_date.isoformat() if self.creation_date else None,
+            'start_date': self.start_date.isoformat() if self.start_date else None,
+            'finish_date': self.finish_date.isoformat() if self.finish_date else None,
+        }
+
+    class Meta:
+        ordering = ('-creation_date',)
+        verbose_name = _('Import Job')
+        verbose_name_plural = _('Import Jobs')
+
+
+class PriceHistory(models.Model):
+    data_import = models.ForeignKey(DataImport, verbose_name=_('Data Import'), related_name='price_history',
+                                    blank=True, null=True, on_delete=models.SET_NULL)
+    creation_date = models.DateTimeField(_('Created date'), auto_now_add=True)
+    changes_count = models.PositiveIntegerField(_('Changed prices'), default=0)
+    # [[stock record id, old price, new price], ...]
+    changes = models.TextField(_('Changes'), blank=True)
+    rolled_back = models.BooleanField(_('Rolled back'), default=False)
+
+    def __str__(self):
+        return '{} ({})'.format(self.creation_date, self.changes_count)
+
+    def set_changes(self, changes):
+        # prices are stored as strings and a missing price as null
+        self.changes = json.dumps([[pk, None if old is None else str(old), None if new is None else str(new)]
+                                   for pk, old, new in changes], separators=(',', ':'))
+        self.changes_count = len(changes)
+
+    def get_changes(self):
+        return json.loads(self.changes) if self.changes else []
+
+    def add_changes(self, changes):
+        # a price changed again keeps its first old price for the rollback
+        merged = OrderedDict((pk, [old, new]) for pk, old, new in self.get_changes())
+        for pk, old, new in changes:
+            merged.setdefault(pk, [old, new])[1] = new
+        self.set_changes([(pk, old, new) for pk, (old, new) in merged.items()])
+
+    class Meta:
+        ordering = ('-creation_date',)
+        verbose_name = _('Price History')
+        verbose_name_plural = _('Price History')
+
+
+class PriceSnapshot(models.Model):
+    stream = models.CharField(_('Supplier file stream'), max_length=256, unique=True)
+    # sorted 64-bit code fingerprints and the prices in cents in the same order
+    codes = models.BinaryField(_('Code fingerprints'), default=b'')
+    prices = models.BinaryField(_('Prices'), default=b'')
+    last_edit_date = models.DateTimeField(_('Updated date'), auto_now=True)
+
+    def __str__(self):
+        return self.stream
+
+    class Meta:
+        verbose_name = _('Price Snapshot')
+        verbose_name_plural = _('Price Snapshots')
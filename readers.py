@@ -0,0 +1,141 @@
+import os
+
+from openpyxl import load_workbook
+
+from django.core.files import File
+from django.db.models import Q
+
+from mediaset.dashboard.transfer.caches import (
+    book_cache, file_hash, iter_book_rows, read_book_index, write_book)
+from mediaset.dashboard.transfer.instrumentation import phase
+from mediaset.dashboard.transfer.models import DataImport, ImportJob
+from mediaset.dashboard.transfer.utils import IMPORT_BATCH_SIZE
+
+
+UPLOAD_HASH_DIR = 'import/sha1'
+
+
+def iter_worksheet_rows(worksheet):
+    """
+    Yields rows as lists with empty cells as ''. The header row is
+    stripped of trailing empty cells and the other rows are cut or padded
+    to its width; empty rows are skipped.
+    """
+    width = None
+    for cells in worksheet.iter_rows():
+        row = ['' if cell.value is None else cell.value for cell in cells]
+        if width is None:
+            while row and row[-1] == '':
+                row.pop()
+            if row:
+                width = len(row)
+                yield row
+            continue
+        row = row[:width] + [''] * (width - len(row))
+        if any(value != '' for value in row):
+            yield row
+
+
+def iter_xlsx_sheets(file_obj):
+    workbook = load_workbook(file_obj, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            yield worksheet.title, iter_worksheet_rows(worksheet)
+    finally:
+        workbook.close()
+
+
+class UploadBook:
+    """
+    Rows of an uploaded xlsx file. The workbook is read once in read-only
+    mode and stored in the book cache; items() then yields
+    (sheet name, rows) pairs with rows read lazily batch by batch.
+    """
+
+    def __init__(self, data_import, batch_size=IMPORT_BATCH_SIZE):
+        self.data_import = data_import
+        self.batch_size = batch_size
+        self.content_hash = data_import.content_hash or file_hash(data_import.upload)
+        self._path = None
+        self._index = None
+
+    def cache_key(self, stage):
+        # keyed by content only, so imports of the same file share the parsed book
+        return '{}-{}'.format(self.content_hash, stage)
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = book_cache.get_path(self.cache_key('parsed')) or self.parse()
+        return self._path
+
+    def parse(self):
+        upload = self.data_import.upload
+        upload.open('rb')
+        try:
+            with phase('parse'):
+                return book_cache.write(self.cache_key('parsed'),
+                                        lambda f: write_book(f, iter_xlsx_sheets(upload), self.batch_size))
+        except Exception:
+            raise ValueError('Некорректный загружаемый файл')
+        finally:
+            upload.close()
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = read_book_index(self.path)
+        return self._index
+
+    def keys(self):
+        return [name for name, offset, count in self.index]
+
+    def items(self):
+        path = self.path
+        for name, offset, count in self.index:
+            yield name, iter_book_rows(path, offset)
+
+    def row_count(self):
+        return sum(count for name, offset, count in self.index)
+
+
+def store_upload(data_import, file_obj):
+    """
+    Sets file_obj as the upload of data_import, stored under the sha1 of
+    its content in UPLOAD_HASH_DIR. A file with the same content is
+    stored only once.
+    """
+    data_import.content_hash = file_hash(file_obj)
+    name = '{}/{}{}'.format(UPLOAD_HASH_DIR, data_import.content_hash, os.path.splitext(file_obj.name)[1].lower())
+    storage = data_import.upload.storage
+    if not storage.exists(name):
+        name = storage.save(name, file_obj)
+    data_import.upload = name
+
+
+def find_duplicate(data_import):
+    """
+    Returns an earlier import of the same file with the same name and
+    stream that was imported or has a finished job, or None. Imports that
+    failed or were never processed are not reused.
+    """
+    if not data_import.content_hash:
+        return None
+    return (DataImport.objects
+            .filter(content_hash=data_import.content_hash, name=data_import.name, stream=data_import.stream)
+            .filter(Q(checkpoint_done=True) | Q(jobs__status=ImportJob.STATUS_DONE))
+            .exclude(pk=data_import.pk)
+            .distinct()
+            .order_by('-id')
+            .first())
+
+
+def create_data_import(path, name='new_import', stream=''):
+    """
+    Stores the file at path as the upload of a new DataImport.
+    """
+    data_import = DataImport(name=name, stream=stream)
+    with open(path, 'rb') as f:
+        store_upload(data_import, File(f, name=os.path.basename(path)))
+    data_import.save()
+    return data_import
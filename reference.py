@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from mediaset.shop.catalogue.models import Category, NewParameter, NewParameterValue, CarBrandModel
+from mediaset.shop.stock.models import Provider
+from mediaset.dashboard.transfer.caches import get_reference_version
+
+
+REFERENCE_MAX_PARAMETERS = getattr(settings, 'TRANSFER_REFERENCE_MAX_PARAMETERS', 500)
+
+
+class ReferenceData:
+    """
+    Ids of categories, providers, parameters, parameter values and car
+    models indexed by name. Every table is loaded with one query on first
+    use. Parameter values are loaded per parameter and only the values of
+    the max_parameters most recently used parameters are kept.
+    """
+
+    def __init__(self, version=None, max_parameters=REFERENCE_MAX_PARAMETERS):
+        self.version = version
+        self.max_parameters = max_parameters
+        self.tables = {}
+        self.values = OrderedDict()
+        self.lock = threading.RLock()
+
+    def table(self, name, load):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = load()
+            return self.tables[name]
+
+    @property
+    def categories(self):
+        return self.table('categories', lambda: dict(Category.objects.values_list('name', 'id')))
+
+    @property
+    def providers(self):
+        return self.table('providers', lambda: dict(Provider.objects.values_list('name', 'id')))
+
+    @property
+    def car_models(self):
+        return self.table('car_models', lambda: dict(CarBrandModel.objects.values_list('value', 'id')))
+
+    @property
+    def parameters(self):
+        return self.table('parameters', lambda: {
+            (category_name, name): pk
+            for category_name, name, pk in NewParameter.objects.values_list('category__name', 'name', 'id')})
+
+    def category_id(self, name):
+        return self.categories.get(name)
+
+    def provider_id(self, name, default=None):
+        return self.providers.get(name, default)
+
+    def car_model_id(self, value):
+        return self.car_models.get(value)
+
+    def parameter_id(self, category_name, name):
+        return self.parameters.get((category_name, name))
+
+    def parameter_values(self, parameter_ids):
+        """
+        Returns {(parameter id, value): value id} for parameter_ids, loading
+        the parameters that are not kept yet with one query.
+        """
+        parameter_ids = set(parameter_ids)
+        with self.lock:
+            missing = [pk for pk in parameter_ids if pk not in self.values]
+            for pk in missing:
+                self.values[pk] = {}
+            for pk, parameter_id, value in NewParameterValue.objects.filter(
+                    parameter_id__in=missing).values_list('id', 'parameter_id', 'value'):
+                self.values[parameter_id][value] = pk
+
+            values = {}
+            for parameter_id in parameter_ids:
+                self.values.move_to_end(parameter_id)
+                values.update(((parameter_id, value), pk) for value, pk in self.values[parameter_id].items())
+            while len(self.values) > self.max_parameters:
+                self.values.popitem(last=False)
+        return values
+
+
+_reference = None
+_reference_lock = threading.Lock()
+
+
+def get_reference_data():
+    """
+    Returns the process-wide reference data, dropped when a reference
+    model changes.
+    """
+    global _reference
+    version = get_reference_version()
+    with _reference_lock:
+        if _reference is None or _reference.version != version:
+            _reference = ReferenceData(version)
+        return _reference
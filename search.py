@@ -0,0 +1,125 @@
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+
+from mediaset.shop.catalogue.models import Product
+from mediaset.dashboard.transfer.caches import get_product_version
+from mediaset.dashboard.transfer.utils import IMPORT_BATCH_SIZE, batched, lookup_batches
+
+
+SEARCH_MAX_MATCHES = getattr(settings, 'TRANSFER_SEARCH_MAX_MATCHES', 5000)
+
+
+class CodeIndex:
+    """
+    Lower-cased product codes kept sorted for exact lookups and joined
+    into one newline separated string, so substring lookups run as
+    str.find. Lookups return the ids of matching products and of their
+    parents.
+    """
+
+    def __init__(self, rows, version=None):
+        rows = sorted((str(code).lower(), pk, parent_id or 0) for code, pk, parent_id in rows)
+        self.version = version
+        self.codes = [code for code, pk, parent_id in rows]
+        self.ids = array('l', [pk for code, pk, parent_id in rows])
+        self.parent_ids = array('l', [parent_id for code, pk, parent_id in rows])
+        self.offsets = array('l')
+        position = 1
+        for code in self.codes:
+            self.offsets.append(position)
+            position += len(code) + 1
+        self.text = '\n' + '\n'.join(self.codes) + '\n'
+
+    @classmethod
+    def build(cls, version=None):
+        return cls(Product.objects.exclude(code=None).values_list('code', 'id', 'parent_id'), version)
+
+    def product_ids(self, positions):
+        ids = set()
+        for position in positions:
+            ids.add(self.ids[position])
+            if self.parent_ids[position]:
+                ids.add(self.parent_ids[position])
+        return ids
+
+    def exact(self, query):
+        query = query.lower()
+        start = bisect_left(self.codes, query)
+        return self.product_ids(range(start, bisect_right(self.codes, query, start)))
+
+    def contains(self, query, limit=SEARCH_MAX_MATCHES):
+        """
+        Ids for codes containing query, or None if more than limit codes match.
+        """
+        query = query.lower()
+        if not query or '\n' in query:
+            return set()
+        positions = []
+        found = self.text.find(query)
+        while found != -1:
+            position = bisect_right(self.offsets, found) - 1
+            positions.append(position)
+            if len(positions) > limit:
+                return None
+            if position + 1 >= len(self.offsets):
+                break
+            # continue with the next code
+            found = self.text.find(query, self.offsets[position + 1])
+        return self.product_ids(positions)
+
+
+class ProductIdList:
+    """
+    Products of queryset with ids in ids, ordered by code, for a paginator.
+    The ids are checked against queryset in batches the database accepts
+    and only the products of a requested slice are loaded.
+    """
+
+    def __init__(self, queryset, ids):
+        self.queryset = queryset
+        self.model = queryset.model
+        rows = []
+        for batch in lookup_batches(ids, 'id'):
+            rows.extend(queryset.filter(id__in=batch).values_list('code', 'id'))
+        self.ids = [pk for code, pk in sorted(rows, key=lambda row: (row[0] or '', row[1]))]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def count(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for ids in batched(self.ids, IMPORT_BATCH_SIZE):
+            yield from self.load(ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.load(self.ids[index])
+        return self.load([self.ids[index]])[0]
+
+    def load(self, ids):
+        products = {}
+        for batch in lookup_batches(ids, 'id'):
+            products.update((product.pk, product) for product in self.queryset.filter(id__in=batch))
+        return [products[pk] for pk in ids if pk in products]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_code_index():
+    """
+    Returns the process-wide code index, rebuilt when a product changes.
+    Stock records and parameter values do not affect it.
+    """
+    global _index
+    version = get_product_version()
+    with _index_lock:
+        if _index is None or _index.version != version:
+            _index = CodeIndex.build(version)
+        return _index
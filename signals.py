@@ -0,0 +1,42 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from mediaset.shop.catalogue.models import (
+    Product, Category, NewProductParameterValue, NewCategoryParameter, NewParameter, NewParameterValue,
+    CarBrandModel)
+from mediaset.shop.stock.models import StockRecord, Provider
+from mediaset.dashboard.transfer.caches import (
+    bump_catalogue_version, bump_product_version, bump_reference_version)
+
+
+CATALOGUE_MODELS = (Product, StockRecord, NewProductParameterValue, NewCategoryParameter)
+REFERENCE_MODELS = (Category, Provider, NewParameter, NewParameterValue, CarBrandModel)
+
+
+def catalogue_changed(sender, **kwargs):
+    transaction.on_commit(bump_catalogue_version)
+
+
+def reference_changed(sender, **kwargs):
+    transaction.on_commit(bump_reference_version)
+
+
+def product_changed(sender, **kwargs):
+    transaction.on_commit(bump_product_version)
+
+
+for model in CATALOGUE_MODELS:
+    post_save.connect(catalogue_changed, sender=model, dispatch_uid='transfer-catalogue-save-{}'.format(model.__name__))
+    post_delete.connect(catalogue_changed, sender=model,
+                        dispatch_uid='transfer-catalogue-delete-{}'.format(model.__name__))
+
+m2m_changed.connect(catalogue_changed, sender=Product.destination.through, dispatch_uid='transfer-catalogue-destination')
+
+for model in REFERENCE_MODELS:
+    post_save.connect(reference_changed, sender=model,
+                      dispatch_uid='transfer-reference-save-{}'.format(model.__name__))
+    post_delete.connect(reference_changed, sender=model,
+                        dispatch_uid='transfer-reference-delete-{}'.format(model.__name__))
+
+post_save.connect(product_changed, sender=Product, dispatch_uid='transfer-product-save')
+post_delete.connect(product_changed, sender=Product, dispatch_uid='transfer-product-delete')
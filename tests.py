@@ -1,3 +1,870 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.http import FileResponse, Http404
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from mediaset.shop.catalogue.models import (
+    Product, NewParameter, NewCategoryParameter, NewParameterValue, NewProductParameterValue, CarBrandModel)
+from mediaset.shop.stock.models import StockRecord, Provider
+from mediaset.dashboard.transfer.benchmarks import SyntheticCatalogue, create_category, write_workbook
+from mediaset.dashboard.transfer.caches import (
+    book_cache, bump_catalogue_version, bump_product_version, bump_reference_version, export_cache,
+    get_catalogue_version, get_product_version, get_reference_version)
+from mediaset.dashboard.transfer.checks import check_shared_cache
+from mediaset.dashboard.transfer.columns import INVALID_PRICE, PriceColumns, StockColumns, parse_cents
+from mediaset.dashboard.transfer.exports import (
+    PRODUCT_FIELDS, PRODUCT_MODIFIED_FIELD, STOCK_FIELDS, STOCK_MODIFIED_FIELD, ExportFilter, ParameterMatrix,
+    cached_export_response, iter_chunk_bounds, iter_chunks, modified_field, price_sheets, product_rows,
+    product_sheets)
+from mediaset.dashboard.transfer.imports import (
+    FULL_HEADER, PRICE_HEADER, ImportCheckpoint, PriceBookValidator, ProductImportPipeline, apply_prices,
+    changed_prices, find_new_objects, iter_new_rows, iter_new_sheet_rows, rollback_prices, stage_prices,
+    update_stock_prices)
+from mediaset.dashboard.transfer.models import DataImport, ImportJob, PriceHistory, ProductPricesTransfer
+from mediaset.dashboard.transfer.readers import UploadBook, create_data_import, find_duplicate, iter_worksheet_rows
+from mediaset.dashboard.transfer.fingerprints import IncrementalPriceBook, PriceFingerprints
+from mediaset.dashboard.transfer.jobs import enqueue_once, full_import_task, heartbeat_cache_key
+from mediaset.dashboard.transfer.instrumentation import add_rows, phase, trace
+from mediaset.dashboard.transfer.reference import ReferenceData, get_reference_data
+from mediaset.dashboard.transfer.search import CodeIndex, ProductIdList, get_code_index
+from mediaset.dashboard.transfer.utils import ordered_map
+from mediaset.dashboard.transfer.views import ImportProductPricesView, UploadImagesView
+
+
+def create_product(category, code, price=None, provider=None):
+    product = Product.objects.create(name='Product {}'.format(code), code=code, category=category)
+    if provider is not None:
+        StockRecord.objects.create(product=product, price=price, provider=provider, num_in_stock=1)
+    return product
+
+
+def stage(data_import, prices):
+    ProductPricesTransfer.objects.bulk_create([
+        ProductPricesTransfer(data_import=data_import, name='item', code=code, product_price=Decimal(price))
+        for code, price in prices.items()])
+
+
+def with_messages(request):
+    request.session = {}
+    request._messages = FallbackStorage(request)
+    return request
+
+
+class TemporaryMediaMixin:
+    """
+    Keeps uploads and file caches of a test in a temporary directory.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        media = override_settings(MEDIA_ROOT=os.path.join(self.directory, 'media'),
+                                  TRANSFER_CACHE_ROOT=os.path.join(self.directory, 'cache'))
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def upload(self, sheets, name='new_import', stream='', file_name='upload.xlsx'):
+        return create_data_import(write_workbook(os.path.join(self.directory, file_name), sheets),
+                                  name=name, stream=stream)
+
+
+class ListBook:
+
+    def __init__(self, sheets):
+        self.sheets = sheets
+
+    def items(self):
+        return iter(self.sheets)
+
+
+Cell = namedtuple('Cell', 'value')
+
+
+class Worksheet:
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def iter_rows(self):
+        return ([Cell(value) for value in row] for row in self.rows)
+
+
+class IterChunksTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category('Chunks')
+        for index, code in enumerate(['B', None, 'A', None, 'C']):
+            Product.objects.create(name='Product {}'.format(index), code=code, category=self.category)
+
+    def test_every_product_once(self):
+        products = Product.objects.filter(category=self.category)
+        chunks = list(iter_chunks(products, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        ids = [product.pk for chunk in chunks for product in chunk]
+        self.assertEqual(ids, sorted(products.values_list('pk', flat=True)))
+
+    def test_product_rows_keep_products_without_code(self):
+        rows = list(product_rows(self.category, [], chunk_size=2))
+        self.assertEqual(sorted(row[0] for row in rows), ['Product {}'.format(index) for index in range(5)])
+
+
+class PriceBookValidatorTest(TestCase):
+
+    def setUp(self):
+        tyres = create_category('Tyres')
+        rims = create_category('Rims')
+        create_product(tyres, 'T1')
+        create_product(tyres, 'T2')
+        create_product(rims, 'R1')
+
+    def test_errors_of_all_rows(self):
+        columns = PriceColumns.from_rows([
+            ['a', 'T1', '10'], ['b', 'R1', '10'], ['c', 'X1', '10'], ['d', 'T2', 'abc'], ['e', 'T1', '12,50'],
+        ], PRICE_HEADER)
+        errors = PriceBookValidator(batch_size=2, workers=1).validate_sheet('Tyres', columns)
+        self.assertEqual(errors, [
+            'В категории Tyres не существует товара с кодом R1',
+            'Товара с кодом X1 не существует',
+            'Товар с кодом T2 имеет неверный формат цены',
+            'Обнаружено дублирование товаров с кодом: T1',
+        ])
+
+    def test_duplicates_reported_once_in_order(self):
+        columns = PriceColumns.from_rows([['a', code, '10'] for code in ['T2', 'T1', 'T1', 'T2', 'T1', 'T2']],
+                                         PRICE_HEADER)
+        errors = PriceBookValidator(workers=1).validate_sheet('Tyres', columns)
+        self.assertEqual(errors, ['Обнаружено дублирование товаров с кодом: T1, T2'])
+
+    def test_valid_sheet(self):
+        columns = PriceColumns.from_rows([['a', ' T1 ', '10'], ['b', 'T2', '10.5']], PRICE_HEADER)
+        self.assertEqual(PriceBookValidator(workers=1).validate_sheet('Tyres', columns), [])
+
+    def test_wrong_header(self):
+        errors = PriceBookValidator(workers=1).validate_sheet('Tyres', PriceColumns(['name', 'code']))
+        self.assertEqual(len(errors), 1)
+        self.assertIn('некорректные названия колонок', errors[0])
+
+
+class ProductImportPipelineTest(TestCase):
+
+    def setUp(self):
+        self.category = create_category('Tyres')
+        self.provider = Provider.objects.create(name='Shop')
+        CarBrandModel.objects.create(value='Audi')
+        parameter = NewParameter.objects.create(name='Width', category=self.category)
+        NewCategoryParameter.objects.create(category=self.category, parameter=parameter)
+        NewParameterValue.objects.create(parameter=parameter, value='205')
+        create_product(self.category, 'OLD')
+        # reference data is reloaded when its version changes, after the commit
+        bump_reference_version()
+
+    def run_import(self, rows):
+        sheet = [FULL_HEADER + ['Width']] + rows
+        pipeline = ProductImportPipeline('Shop', commit_size=0)
+        return pipeline.run(iter_new_sheet_rows('Tyres', sheet, batch_size=2))
+
+    def test_creates_new_products(self):
+        created = self.run_import([
+            ['New', 'N1', 'Text', '10,50', 'Shop', '3', 'Audi', '205'],
+            ['Repeated', 'N1', 'Text', '11', 'Shop', '3', 'Audi', '205'],
+            ['Old', 'OLD', 'Text', '12', 'Shop', '3', '', ''],
+            ['Other', 'N2', '', '', 'Unknown', '', 'Unknown', '999'],
+        ])
+        self.assertEqual(created, 2)
+        self.assertEqual(Product.objects.filter(code='OLD').count(), 1)
+
+        product = Product.objects.get(code='N1')
+        self.assertEqual(product.name, 'New')
+        stock_record = StockRecord.objects.get(product=product)
+        self.assertEqual((stock_record.price, stock_record.provider, stock_record.num_in_stock),
+                         (Decimal('10.50'), self.provider, 3))
+        self.assertEqual(list(product.destination.values_list('value', flat=True)), ['Audi'])
+        self.assertEqual(list(NewProductParameterValue.objects.filter(product=product).values_list(
+            'parameter__name', 'value__value')), [('Width', '205')])
+
+        other = Product.objects.get(code='N2')
+        stock_record = StockRecord.objects.get(product=other)
+        self.assertEqual((stock_record.price, stock_record.provider, stock_record.num_in_stock),
+                         (Decimal('0'), self.provider, 1))
+        self.assertFalse(other.destination.exists())
+        self.assertFalse(NewProductParameterValue.objects.filter(product=other).exists())
+
+    def test_invalid_price_writes_nothing(self):
+        with self.assertRaises(ValueError):
+            self.run_import([
+                ['New', 'N1', 'Text', '10', 'Shop', '3', '', ''],
+                ['Other', 'N2', 'Text', '10', 'Shop', '3', '', ''],
+                ['Broken', 'N3', 'Text', 'abc', 'Shop', '3', '', ''],
+            ])
+        self.assertFalse(Product.objects.filter(code__in=['N1', 'N2', 'N3']).exists())
+
+    def test_unknown_parameter(self):
+        with self.assertRaises(ValueError):
+            ProductImportPipeline('Shop', commit_size=0).run(
+                iter_new_sheet_rows('Tyres', [FULL_HEADER + ['Height'], ['New', 'N1', '', '1', '', '', '', '']]))
+
+
+class ChangedPricesTest(TestCase):
+
+    def setUp(self):
+        category = create_category('Tyres')
+        provider = Provider.objects.create(name='Shop')
+        for code, price in [('A', '10.00'), ('B', '20.00'), ('C', '30.00'), ('D', None)]:
+            create_product(category, code, price and Decimal(price), provider)
+        self.data_import = DataImport.objects.create(upload='import/prices.xlsx')
+
+    def test_changed_prices_only(self):
+        stage(self.data_import, {'A': '10.00', 'B': '21.00', 'D': '5.00', 'X': '1.00'})
+        changed = [(record.product.code, record.price, record.new_price)
+                   for record in changed_prices(self.data_import).select_related('product')]
+        self.assertEqual(changed, [('B', Decimal('20.00'), Decimal('21.00')), ('D', None, Decimal('5.00'))])
+
+    def test_other_imports_are_ignored(self):
+        other = DataImport.objects.create(upload='import/other.xlsx')
+        stage(other, {'A': '11.00', 'C': '31.00'})
+        stage(self.data_import, {'C': '32.00'})
+        self.assertEqual([record.new_price for record in changed_prices(self.data_import)], [Decimal('32.00')])
+
+
+class WorksheetRowsTest(TestCase):
+
+    def test_rows_fit_the_header(self):
+        worksheet = Worksheet([
+            [None, None],
+            ['name', 'code', 'price', None],
+            ['a', 'A1', 10, 'note'],
+            ['b', None],
+            [None, None, None, None],
+            ['c', 'C1', 0],
+        ])
+        self.assertEqual(list(iter_worksheet_rows(worksheet)), [
+            ['name', 'code', 'price'],
+            ['a', 'A1', 10],
+            ['b', '', ''],
+            ['c', 'C1', 0],
+        ])
+
+    def test_empty_sheet(self):
+        self.assertEqual(list(iter_worksheet_rows(Worksheet([[None], []]))), [])
+
+
+class PriceUpdateTest(TestCase):
+
+    def setUp(self):
+        category = create_category('Tyres')
+        provider = Provider.objects.create(name='Shop')
+        self.records = {}
+        for code, price in [('A', Decimal('10.00')), ('B', Decimal('20.00')), ('C', None)]:
+            product = create_product(category, code, price, provider)
+            self.records[code] = StockRecord.objects.get(product=product)
+
+    def prices(self):
+        return dict(StockRecord.objects.values_list('product__code', 'price'))
+
+    def test_update_stock_prices(self):
+        update_stock_prices([(self.records['A'].pk, Decimal('11.00')), (self.records['B'].pk, None),
+                             (self.records['C'].pk, Decimal('3.50'))], batch_size=2)
+        self.assertEqual(self.prices(), {'A': Decimal('11.00'), 'B': None, 'C': Decimal('3.50')})
+
+    def test_apply_and_rollback(self):
+        history = apply_prices(PriceColumns.from_rows([['a', 'A', '10'], ['b', 'B', '25'], ['c', 'C', '7,5']]))
+        self.assertEqual(self.prices(), {'A': Decimal('10.00'), 'B': Decimal('25.00'), 'C': Decimal('7.50')})
+        self.assertEqual(history.changes_count, 2)
+
+        history = PriceHistory.objects.get(pk=history.pk)
+        self.assertEqual(sorted(history.get_changes()), sorted([
+            [self.records['B'].pk, '20.00', '25.00'], [self.records['C'].pk, None, '7.50']]))
+
+        rollback_prices(history)
+        self.assertEqual(self.prices(), {'A': Decimal('10.00'), 'B': Decimal('20.00'), 'C': None})
+        self.assertTrue(PriceHistory.objects.get(pk=history.pk).rolled_back)
+
+    def test_batches_fold_into_one_history_entry(self):
+        history = apply_prices(PriceColumns.from_rows([['b', 'B', '25']]))
+        history = apply_prices(PriceColumns.from_rows([['a', 'A', '10'], ['b', 'B', '30']]), history=history)
+        self.assertEqual(PriceHistory.objects.get().get_changes(), [[self.records['B'].pk, '20.00', '30.00']])
+
+        rollback_prices(history)
+        self.assertEqual(self.prices()['B'], Decimal('20.00'))
+
+
+class ImportProductPricesViewTest(TestCase):
+
+    def setUp(self):
+        category = create_category('Tyres')
+        provider = Provider.objects.create(name='Shop')
+        create_product(category, 'A', Decimal('10.00'), provider)
+        create_product(category, 'B', Decimal('20.00'), provider)
+        self.data_import = DataImport.objects.create(upload='import/prices.xlsx')
+        other = DataImport.objects.create(upload='import/other.xlsx')
+        stage(self.data_import, {'A': '12.00'})
+        stage(other, {'B': '25.00'})
+        self.factory = RequestFactory()
+
+    def get_rows(self, request):
+        view = ImportProductPricesView()
+        view.request = request
+        return view.get_queryset()
+
+    def test_rows_of_the_import(self):
+        rows = self.get_rows(self.factory.get('/', {'import': self.data_import.pk}))
+        self.assertEqual(rows, [['Product A', 'A', Decimal('10.00'), Decimal('12.00')]])
+
+    def test_import_is_required(self):
+        for query in [{}, {'import': ''}, {'import': 'abc'}, {'import': '-1'}, {'import': '999999'}]:
+            with self.assertRaises(Http404):
+                self.get_rows(self.factory.get('/', query))
+
+    def test_post_enqueues_the_import(self):
+        request = with_messages(self.factory.post(
+            '/', {'import': self.data_import.pk, 'item': ['A'], 'new': ['12.00']}))
+        response = ImportProductPricesView.as_view()(request)
+        self.assertEqual(response.status_code, 302)
+        job = ImportJob.objects.get()
+        self.assertEqual((job.kind, job.data_import), (ImportJob.KIND_APPLY_PRICES, self.data_import))
+
+    def test_post_without_import(self):
+        request = with_messages(self.factory.post('/', {'item': ['A'], 'new': ['12.00']}))
+        with self.assertRaises(Http404):
+            ImportProductPricesView.as_view()(request)
+        self.assertFalse(ImportJob.objects.exists())
+
+
+class UploadImagesViewTest(TestCase):
+
+    def setUp(self):
+        category = create_category('Tyres')
+        for index in range(25):
+            create_product(category, 'P{:02}'.format(index))
+
+    def test_formsets_for_page_products_only(self):
+        response = UploadImagesView.as_view()(RequestFactory().get('/'))
+        formsets = sorted(key for key in response.context_data if key.endswith('_image_formset'))
+        self.assertEqual(formsets, ['P{:02}_image_formset'.format(index) for index in range(20)])
+
+    def test_page_images_are_loaded_once(self):
+        products = Product.objects.filter(code__in=['P00', 'P01', 'P02'])
+        # one query for the products, one for their images
+        with self.assertNumQueries(2):
+            for formset in UploadImagesView().get_image_formsets(products).values():
+                formset.forms
+
+    def test_post_builds_submitted_formsets_only(self):
+        request = RequestFactory().post('/', {'P03-TOTAL_FORMS': '0', 'P03-INITIAL_FORMS': '0', 'code': 'P04'})
+        view = UploadImagesView()
+        view.request = request
+        with mock.patch.object(UploadImagesView, 'all_formset_valid', lambda self, formsets: formsets), \
+                mock.patch.object(UploadImagesView, 'all_formset_invalid', lambda self, formsets: formsets):
+            self.assertEqual(list(view.post(request)), ['P03'])
+
+
+class CodeSearchTest(TestCase):
+
+    def test_exact_and_contains(self):
+        index = CodeIndex([('AB-100', 1, None), ('ab-200', 2, 10), ('XY-100', 3, None), ('AB', 4, None)])
+        self.assertEqual(index.exact('ab'), {4})
+        self.assertEqual(index.exact('AB-200'), {2, 10})
+        self.assertEqual(index.contains('-100'), {1, 3})
+        self.assertEqual(index.contains('b'), {1, 2, 4, 10})
+        self.assertEqual(index.contains('zz'), set())
+        self.assertIsNone(index.contains('ab', limit=2))
+
+    def test_index_follows_product_changes_only(self):
+        index = get_code_index()
+        bump_catalogue_version()
+        self.assertIs(get_code_index(), index)
+        bump_product_version()
+        self.assertIsNot(get_code_index(), index)
+
+    def test_id_list_pages_many_ids(self):
+        category = create_category('Tyres')
+        Product.objects.bulk_create([Product(name='Product {}'.format(number), code='C{:04d}'.format(number),
+                                             category=category) for number in range(1500)])
+        ids = list(Product.objects.values_list('id', flat=True))
+        queryset = Product.objects.exclude(code='C0001')
+
+        products = ProductIdList(queryset, ids + [0])
+        self.assertEqual(products.count(), 1499)
+        self.assertEqual([product.code for product in products[:3]], ['C0000', 'C0002', 'C0003'])
+        self.assertEqual(products[-1].code, 'C1499')
+        self.assertEqual(len(list(products)), 1499)
+
+
+class TraceTest(TestCase):
+
+    def work(self, number):
+        with phase('work'):
+            add_rows(number)
+            Product.objects.exists()
+        return number
+
+    def test_worker_threads_are_traced(self):
+        with trace('threads') as record:
+            self.assertEqual(list(ordered_map(self.work, range(1, 6), workers=2)), [1, 2, 3, 4, 5])
+        self.assertEqual(record.rows, 15)
+        self.assertEqual(record.queries.count, 5)
+        self.assertIn('work', record.phases)
+
+    def test_enclosing_traces_count_worker_queries(self):
+        with trace('outer') as outer:
+            with trace('inner') as inner:
+                list(ordered_map(self.work, range(1, 4), workers=2))
+            Product.objects.exists()
+        self.assertEqual((inner.queries.count, outer.queries.count), (3, 4))
+        self.assertEqual((inner.rows, outer.rows), (6, 0))
+
+    def test_calling_thread(self):
+        with trace('calling thread') as record:
+            list(ordered_map(self.work, range(1, 4), workers=1))
+        self.assertEqual((record.rows, record.queries.count, record.phases['work']['queries']), (6, 3, 3))
+
+    def test_queries_are_counted_without_the_debug_log(self):
+        connection.queries_log.extend([{}] * connection.queries_log.maxlen)
+        self.addCleanup(connection.queries_log.clear)
+        with trace('full log') as record:
+            self.assertEqual(connection.queries_logged, settings.DEBUG)
+            Product.objects.exists()
+            Product.objects.exists()
+        self.assertEqual(record.queries.count, 2)
+
+
+class OrderedMapTest(TestCase):
+
+    def test_errors_are_raised_in_order(self):
+        def square(number):
+            if number in (3, 7):
+                raise ValueError(number)
+            return number * number
+
+        results = ordered_map(square, range(10), workers=3)
+        self.assertEqual([next(results) for number in range(3)], [0, 1, 4])
+        with self.assertRaisesRegex(ValueError, '3'):
+            next(results)
+
+    def test_sheet_errors_in_book_order(self):
+        book = ListBook([('Zeta', [FULL_HEADER]), ('Alpha', [FULL_HEADER]), ('Mu', [])])
+        with self.assertRaises(ValueError) as raised:
+            find_new_objects(book, workers=2)
+        self.assertEqual(str(raised.exception).split('\n'), [
+            'Лист Zeta: Категории Zeta не существует', 'Лист Alpha: Категории Alpha не существует'])
+
+
+class FileCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_directory_follows_settings(self):
+        with override_settings(TRANSFER_CACHE_ROOT=self.directory):
+            self.assertEqual(book_cache.directory, os.path.join(self.directory, 'books'))
+            book_cache.set('value', {'a': 1})
+            self.assertEqual(book_cache.get('value'), {'a': 1})
+            self.assertTrue(os.path.exists(os.path.join(self.directory, 'books', 'value.cache')))
+        self.assertNotEqual(book_cache.directory, os.path.join(self.directory, 'books'))
+
+
+class UploadBookTest(TemporaryMediaMixin, TestCase):
+
+    def test_parsed_once(self):
+        data_import = self.upload([('Tyres', [PRICE_HEADER, ['a', 'A1', 10], ['b', 'B1', '12,5']]),
+                                   ('Rims', [PRICE_HEADER])])
+        book = UploadBook(data_import)
+        self.assertEqual(book.keys(), ['Tyres', 'Rims'])
+        self.assertEqual([(name, list(rows)) for name, rows in book.items()], [
+            ('Tyres', [PRICE_HEADER, ['a', 'A1', 10], ['b', 'B1', '12,5']]), ('Rims', [PRICE_HEADER])])
+        self.assertEqual(book.row_count(), 4)
+
+        with mock.patch('mediaset.dashboard.transfer.readers.iter_xlsx_sheets') as iter_xlsx_sheets:
+            self.assertEqual(UploadBook(data_import).keys(), ['Tyres', 'Rims'])
+        iter_xlsx_sheets.assert_not_called()
+
+    def test_invalid_file(self):
+        path = os.path.join(self.directory, 'broken.xlsx')
+        with open(path, 'wb') as f:
+            f.write(b'not a workbook')
+        with self.assertRaises(ValueError):
+            UploadBook(create_data_import(path)).keys()
+
+
+class ExportCacheTest(TemporaryMediaMixin, TestCase):
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_tee_stores_complete_streams(self):
+        chunks = export_cache.tee('entry', iter([b'a', b'b']))
+        self.assertEqual(next(chunks), b'a')
+        chunks.close()
+        self.assertIsNone(export_cache.get_path('entry'))
+
+        self.assertEqual(list(export_cache.tee('entry', iter([b'a', b'b']))), [b'a', b'b'])
+        self.assertEqual(self.read(export_cache.get_path('entry')), b'ab')
+
+    def test_tee_waits_for_the_build_lock_holder(self):
+        cache.add(export_cache.lock_key('entry'), 1)
+        self.addCleanup(cache.delete, export_cache.lock_key('entry'))
+
+        def build(seconds):
+            export_cache.write('entry', lambda f: f.write(b'built'))
+
+        with mock.patch('mediaset.dashboard.transfer.caches.time.sleep', side_effect=build) as sleep:
+            self.assertEqual(b''.join(export_cache.tee('entry', iter([b'a']))), b'built')
+        self.assertEqual(sleep.call_count, 1)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache_is_reported(self):
+        self.assertEqual([warning.id for warning in check_shared_cache(None)], ['transfer.W001'])
+
+    def test_csv_is_streamed_then_served_from_cache(self):
+        create_category('Tyres')
+        request = RequestFactory().get('/', {'format': 'csv'})
+        expected = 'category,{}\r\n'.format(','.join(PRODUCT_FIELDS + STOCK_FIELDS)).encode()
+
+        response = cached_export_response(request, 'blank', 'blank')
+        self.assertNotIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), expected)
+
+        response = cached_export_response(request, 'blank', 'blank')
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), expected)
+        response.close()
+
+        bump_reference_version()
+        response = cached_export_response(request, 'blank', 'blank')
+        self.assertNotIsInstance(response, FileResponse)
+        response.close()
+
+
+class SignalInvalidationTest(TransactionTestCase):
+    # versions are bumped on commit, which TestCase never reaches
+
+    def test_product_change_bumps_catalogue_and_product_versions(self):
+        category = create_category('Tyres')
+        catalogue_version, product_version = get_catalogue_version(), get_product_version()
+        Product.objects.create(name='Product A', code='A', category=category)
+        self.assertNotEqual(get_catalogue_version(), catalogue_version)
+        self.assertNotEqual(get_product_version(), product_version)
+
+    def test_category_rename_bumps_reference_version(self):
+        category = create_category('Tyres')
+        reference_version = get_reference_version()
+        category.name = 'Disks'
+        category.save()
+        self.assertNotEqual(get_reference_version(), reference_version)
+
+
+class ConcurrentExportTest(TransactionTestCase):
+    # worker threads use their own connections and only see committed rows
+
+    def setUp(self):
+        SyntheticCatalogue(25, categories=2, parameters=2).create()
+
+    def sheets(self, sheets_func, workers):
+        return [(title, header, list(rows)) for title, header, rows in sheets_func(workers=workers, chunk_size=4)]
+
+    def test_chunk_bounds(self):
+        bounds = list(iter_chunk_bounds(Product.objects.all(), chunk_size=10))
+        ids = sorted(Product.objects.values_list('pk', flat=True))
+        self.assertEqual(bounds, [(None, ids[9]), (ids[9], ids[19]), (ids[19], ids[24])])
+
+    def test_same_rows_as_sequential_export(self):
+        for sheets_func in (price_sheets, product_sheets):
+            sheets = self.sheets(sheets_func, workers=1)
+            self.assertEqual(sum(len(rows) for title, header, rows in sheets), 25)
+            self.assertEqual(self.sheets(sheets_func, workers=3), sheets)
+
+
+class ParameterMatrixTest(unittest.TestCase):
+
+    def test_rows_follow_product_order(self):
+        matrix = ParameterMatrix([7, 3], ['Color', 'Size'])
+        matrix.set(3, 'Size', 'L')
+        matrix.set(7, 'Color', 'Red')
+        self.assertEqual(matrix.row(0), ['Red', ''])
+        self.assertEqual(matrix.row(1), ['', 'L'])
+
+    def test_without_parameters(self):
+        self.assertEqual(ParameterMatrix([7, 3], []).row(1), [])
+
+
+class ExportFilterTest(TestCase):
+
+    def test_invalid_filter_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ExportFilter.from_request(RequestFactory().get('/', {'category': 'missing'}))
+        self.assertFalse(ExportFilter.from_request(RequestFactory().get('/')))
+
+    @override_settings(TRANSFER_PRODUCT_MODIFIED_FIELD='missing')
+    def test_unknown_modified_field(self):
+        with self.assertRaises(ImproperlyConfigured):
+            modified_field(Product, 'TRANSFER_PRODUCT_MODIFIED_FIELD', 'date_updated')
+
+    @unittest.skipUnless(PRODUCT_MODIFIED_FIELD and STOCK_MODIFIED_FIELD, 'no modification fields')
+    def test_delta_export_reads_modified_products_only(self):
+        provider = Provider.objects.create(name='Shop')
+        category = create_category('Tyres')
+        create_category('Disks')
+        for code in ('A', 'B', 'C'):
+            create_product(category, code, '10.00', provider)
+        since = timezone.now()
+        old = since - datetime.timedelta(days=1)
+        Product.objects.update(**{PRODUCT_MODIFIED_FIELD: old})
+        StockRecord.objects.update(**{STOCK_MODIFIED_FIELD: old})
+        StockRecord.objects.filter(product__code='B').update(**{STOCK_MODIFIED_FIELD: since})
+
+        sheets = [(title, list(rows)) for title, header, rows in price_sheets(
+            workers=1, export_filter=ExportFilter(since=since))]
+        self.assertEqual(sheets, [('Tyres', [['Product B', 'B', '10.00']])])
+
+
+class IncrementalPriceImportTest(TemporaryMediaMixin, TestCase):
+
+    def stage_changed_rows(self, rows, file_name, apply=True):
+        data_import = self.upload([('Tyres', [PRICE_HEADER] + rows)], stream='supplier', file_name=file_name)
+        book = IncrementalPriceBook(UploadBook(data_import), PriceFingerprints.for_stream('supplier'))
+        changed = [row for name, sheet in book.items() for row in list(sheet)[1:]]
+        # only the first changed row is posted for staging and applied
+        stage_prices(PriceColumns.from_rows(changed[:1]), data_import)
+        if apply:
+            apply_prices(PriceColumns.from_rows(changed[:1]), data_import=data_import)
+        return [row[1] for row in changed]
+
+    def test_second_upload_stages_changed_rows_only(self):
+        self.assertEqual(self.stage_changed_rows([['a', 'A', 10], ['b', 'B', 20]], 'first.xlsx'), ['A', 'B'])
+        self.assertEqual(self.stage_changed_rows([['a', 'A', 10], ['b', 'B', 20], ['c', 'C', 5]], 'second.xlsx'),
+                         ['C'])
+        self.assertEqual(self.stage_changed_rows([['a', 'A', '10.00'], ['b', 'B', 25], ['c', 'C', 5]],
+                                                 'third.xlsx'), ['B'])
+
+    def test_prices_staged_but_not_applied_are_shown_again(self):
+        rows = [['a', 'A', 10], ['b', 'B', 20]]
+        self.assertEqual(self.stage_changed_rows(rows, 'first.xlsx', apply=False), ['A', 'B'])
+        self.assertEqual(self.stage_changed_rows(rows, 'second.xlsx'), ['A', 'B'])
+
+
+class ReferenceDataTest(TestCase):
+
+    def setUp(self):
+        category = create_category('Tyres')
+        self.parameters = []
+        for name in ('Width', 'Height', 'Season'):
+            parameter = NewParameter.objects.create(name=name, category=category)
+            NewParameterValue.objects.create(parameter=parameter, value='{} value'.format(name))
+            self.parameters.append(parameter)
+
+    def test_tables_are_loaded_once(self):
+        reference = ReferenceData()
+        with self.assertNumQueries(1):
+            self.assertEqual(reference.parameter_id('Tyres', 'Width'), self.parameters[0].id)
+            self.assertIsNone(reference.parameter_id('Tyres', 'Depth'))
+            self.assertIsNone(reference.parameter_id('Rims', 'Width'))
+
+    def test_values_of_recent_parameters_are_kept(self):
+        reference = ReferenceData(max_parameters=2)
+        width, height, season = self.parameters
+        with self.assertNumQueries(3):
+            values = reference.parameter_values([width.id])
+            reference.parameter_values([height.id])
+            reference.parameter_values([season.id])
+        self.assertEqual(list(values), [(width.id, 'Width value')])
+        self.assertEqual(list(reference.values), [height.id, season.id])
+
+        with self.assertNumQueries(0):
+            reference.parameter_values([height.id, season.id])
+        with self.assertNumQueries(1):
+            values = reference.parameter_values([width.id])
+        self.assertEqual(list(values), [(width.id, 'Width value')])
+
+    def test_shared_data_follows_reference_version(self):
+        reference = get_reference_data()
+        self.assertIs(get_reference_data(), reference)
+        bump_reference_version()
+        self.assertIsNot(get_reference_data(), reference)
+
+
+class RecordingCheckpoint:
+
+    def __init__(self, start):
+        self.row = start
+        self.saves = []
+        self.finished = False
+
+    def start(self, sheet):
+        return self.row
+
+    def save(self, sheet, row):
+        self.saves.append((sheet, row))
+
+    def finish(self):
+        self.finished = True
+
+
+class CheckpointedImportTest(TestCase):
+
+    def setUp(self):
+        create_category('Tyres')
+        Provider.objects.create(name='Shop')
+        bump_reference_version()
+        self.book = ListBook([('Tyres', [FULL_HEADER] + [
+            ['Product {}'.format(number), 'N{}'.format(number), '', '1', 'Shop', '1', ''] for number in range(7)])])
+
+    def run_import(self, checkpoint, commit_size=2):
+        pipeline = ProductImportPipeline('Shop', batch_size=1, commit_size=commit_size)
+        return pipeline.run(iter_new_rows(self.book, batch_size=1, checkpoint=checkpoint), checkpoint)
+
+    def test_resume_after_checkpoint(self):
+        data_import = DataImport.objects.create(upload='import/full.xlsx', checkpoint_sheet='Tyres', checkpoint_row=4)
+        self.assertEqual(self.run_import(ImportCheckpoint(data_import)), 3)
+        self.assertEqual(sorted(Product.objects.values_list('code', flat=True)), ['N4', 'N5', 'N6'])
+
+        data_import.refresh_from_db()
+        self.assertEqual((data_import.checkpoint_sheet, data_import.checkpoint_row, data_import.checkpoint_done),
+                         ('Tyres', 7, True))
+        self.assertEqual(self.run_import(ImportCheckpoint(data_import)), 0)
+
+    def test_skipped_rows_do_not_count_towards_commits(self):
+        checkpoint = RecordingCheckpoint(3)
+        self.run_import(checkpoint)
+        self.assertEqual(checkpoint.saves, [('Tyres', 5), ('Tyres', 7)])
+        self.assertTrue(checkpoint.finished)
+
+    def test_one_transaction_without_commit_size(self):
+        checkpoint = RecordingCheckpoint(0)
+        self.assertEqual(self.run_import(checkpoint, commit_size=0), 7)
+        self.assertEqual(checkpoint.saves, [('Tyres', 7)])
+
+
+class EnqueueOnceTest(TestCase):
+
+    def test_one_active_job_per_import(self):
+        data_import = DataImport.objects.create(upload='import/full.xlsx')
+        job = enqueue_once(ImportJob.KIND_FULL, full_import_task, data_import.id, 'Shop', data_import=data_import)
+        self.assertIsNotNone(job)
+        self.assertIsNone(
+            enqueue_once(ImportJob.KIND_FULL, full_import_task, data_import.id, 'Shop', data_import=data_import))
+
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.STATUS_FAILED)
+        self.assertIsNotNone(
+            enqueue_once(ImportJob.KIND_FULL, full_import_task, data_import.id, 'Shop', data_import=data_import))
+
+    def test_interrupted_job_is_resumed(self):
+        data_import = DataImport.objects.create(upload='import/full.xlsx', checkpoint_sheet='Tyres', checkpoint_row=5)
+        job = ImportJob.objects.create(kind=ImportJob.KIND_FULL, data_import=data_import,
+                                       status=ImportJob.STATUS_RUNNING, start_date=timezone.now())
+        cache.set(heartbeat_cache_key(job.id), 1)
+        self.assertIsNone(
+            enqueue_once(ImportJob.KIND_FULL, full_import_task, data_import.id, 'Shop', data_import=data_import))
+
+        # the process running the job died and its heartbeat expired
+        cache.delete(heartbeat_cache_key(job.id))
+        self.assertIsNotNone(
+            enqueue_once(ImportJob.KIND_FULL, full_import_task, data_import.id, 'Shop', data_import=data_import))
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.STATUS_FAILED)
+
+
+class PriceImportCommandTest(TemporaryMediaMixin, TransactionTestCase):
+    # validation runs in worker threads, which only see committed rows
+
+    def setUp(self):
+        super().setUp()
+        category = create_category('Tyres')
+        provider = Provider.objects.create(name='Shop')
+        for code, price in [('A', '10.00'), ('B', '20.00'), ('C', '30.00')]:
+            create_product(category, code, Decimal(price), provider)
+        self.path = write_workbook(os.path.join(self.directory, 'prices.xlsx'), [
+            ('Tyres', [PRICE_HEADER, ['a', 'A', 11], ['b', 'B', 20], ['c', 'C', 31]])])
+
+    def prices(self):
+        return dict(StockRecord.objects.values_list('product__code', 'price'))
+
+    def import_prices(self, *args, **options):
+        call_command('transfer_import_prices', *args, batch_size=1, commit_size=2, stdout=io.StringIO(), **options)
+
+    def test_stage_and_apply_in_chunks(self):
+        self.import_prices(self.path, apply=True)
+        self.assertEqual(self.prices(), {'A': Decimal('11.00'), 'B': Decimal('20.00'), 'C': Decimal('31.00')})
+        data_import = DataImport.objects.get()
+        self.assertEqual((data_import.checkpoint_sheet, data_import.checkpoint_row, data_import.checkpoint_done),
+                         ('Tyres', 3, True))
+        self.assertEqual(data_import.price_transfers.count(), 3)
+        # one history entry for the import, however many batches were applied
+        self.assertEqual(list(data_import.price_history.values_list('changes_count', flat=True)), [2])
+
+    def test_resume(self):
+        data_import = create_data_import(self.path)
+        DataImport.objects.filter(pk=data_import.pk).update(checkpoint_sheet='Tyres', checkpoint_row=2)
+        self.import_prices(resume=data_import.pk, apply=True)
+        self.assertEqual(self.prices(), {'A': Decimal('10.00'), 'B': Decimal('20.00'), 'C': Decimal('31.00')})
+        self.assertEqual(list(data_import.price_transfers.values_list('code', flat=True)), ['C'])
+
+
+class PriceColumnsTest(TestCase):
+
+    def test_parse_cents(self):
+        self.assertEqual([parse_cents(value) for value in [10, '12,5', '0.015', ' 7 ', 'abc', '', None, '1e30']],
+                         [1000, 1250, 2, 700, INVALID_PRICE, INVALID_PRICE, INVALID_PRICE, INVALID_PRICE])
+
+    def test_columns(self):
+        columns = PriceColumns.from_rows([['a', ' A1 ', '10'], ['b', 2, 'x'], ['c', 'A1', '11.99']], PRICE_HEADER)
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(columns.codes, ['A1', '2', 'A1'])
+        self.assertEqual(columns.invalid_codes(), ['2'])
+        self.assertEqual(columns.prices(), {'A1': 1199})
+        self.assertEqual(columns.slice(1, 3).codes, ['2', 'A1'])
+        self.assertEqual(columns.slice(1, 3).header, PRICE_HEADER)
+
+    def test_stock_columns(self):
+        columns = StockColumns([['a', 'A1', '', '', 'Shop', '', ''], ['b', 'B1', '', '5,5', 'Other', '3.0', '']])
+        self.assertEqual(list(columns.cents), [0, 550])
+        self.assertEqual(list(columns.num_in_stock), [1, 3])
+        self.assertEqual(columns.providers, ['Shop', 'Other'])
+
+
+class DuplicateUploadTest(TemporaryMediaMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sheets = [('Tyres', [PRICE_HEADER, ['a', 'A', 10]])]
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload(self.sheets, file_name='first.xlsx')
+        second = self.upload(self.sheets, file_name='second.xlsx')
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertEqual(first.upload.name, second.upload.name)
+
+    def test_only_processed_imports_are_reused(self):
+        first = self.upload(self.sheets)
+        second = self.upload(self.sheets)
+        self.assertIsNone(find_duplicate(second))
+
+        job = ImportJob.objects.create(kind=ImportJob.KIND_PRICES, data_import=first, status=ImportJob.STATUS_FAILED)
+        self.assertIsNone(find_duplicate(second))
+
+        ImportJob.objects.create(kind=ImportJob.KIND_PRICES, data_import=first, status=ImportJob.STATUS_DONE)
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.STATUS_DONE)
+        self.assertEqual(find_duplicate(second), first)
+        self.assertIsNone(find_duplicate(self.upload(self.sheets, stream='supplier')))
+
+    def test_imported_full_import_is_reused(self):
+        first = self.upload(self.sheets, name='new_import_all')
+        DataImport.objects.filter(pk=first.pk).update(checkpoint_done=True)
+        self.assertEqual(find_duplicate(self.upload(self.sheets, name='new_import_all')), first)
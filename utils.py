@@ -0,0 +1,107 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.conf import settings
+from django.db import connection
+
+from mediaset.dashboard.transfer.instrumentation import in_trace
+
+
+IMPORT_BATCH_SIZE = getattr(settings, 'TRANSFER_IMPORT_BATCH_SIZE', 1000)
+IMPORT_COMMIT_SIZE = getattr(settings, 'TRANSFER_IMPORT_COMMIT_SIZE', 10000)
+
+
+def normalize_code(code):
+    return str(code).strip()
+
+
+def parse_price(value):
+    try:
+        return Decimal(str(value).replace(',', '.'))
+    except InvalidOperation:
+        raise ValueError(value)
+
+
+def parse_num_in_stock(value):
+    try:
+        return int(Decimal(str(value)))
+    except (InvalidOperation, ValueError):
+        return 1
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def lookup_batches(values, field='code', max_size=None):
+    """
+    Splits values for a ``field__in`` lookup into as few batches as the
+    database backend allows (one batch on PostgreSQL), of at most
+    max_size values if it is given.
+    """
+    values = list(values)
+    if not values:
+        return []
+    size = connection.ops.bulk_batch_size([field], values) or len(values)
+    return batched(values, min(size, max_size or size))
+
+
+def ordered_map(func, items, workers):
+    """
+    Like map(), but calls func in workers threads. At most 2 * workers
+    items are pending at a time and the results are yielded in the order
+    of items. Calls run in the trace of the calling thread. Every thread
+    uses its own database connection, which is closed when the thread is
+    done.
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    func = in_trace(func)
+    tasks = queue.Queue()
+
+    def work():
+        try:
+            while True:
+                task = tasks.get()
+                if task is None:
+                    return
+                future, item = task
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(func(item))
+                    except Exception as e:
+                        future.set_exception(e)
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=work, daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    pending = deque()
+    try:
+        for item in items:
+            future = Future()
+            tasks.put((future, item))
+            pending.append(future)
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()